@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+"""
+Sensor synchronized acquisition for dual photography.
+
+Instead of moving the laser to a pixel, stopping and reading the sensor, the
+whole raster (laser_lib.RasterScan) is streamed to the dac on one thread while
+a capture thread reads timestamped samples from the sensor. Afterwards every
+sample is assigned to the pixel that was lit when it was taken, using the
+dac's point schedule, so laser motion and sensor exposure overlap.
+
+Sensors are objects with a read() method that blocks until the next sample
+and returns (timestamp, value), timestamps in time.perf_counter() seconds
+(the middle of the exposure). Timestamps that are late by a pixel or more
+put samples on the wrong pixels, in opposite directions on serpentine rows,
+so the image zig-zags. measure_latency finds how late they are by flashing
+the laser, for CameraSensor's latency or the pipeline's sensor_offset.
+
+Run this file to scan a synthetic scene with the simulated dac.
+"""
+
+import os
+import threading
+import time
+import numpy as np
+import laser_lib
+
+class CameraSensor:
+    '''
+    Mean brightness of webcam frames (a cv2.VideoCapture). latency is how long
+    before read() returns the middle of the frame's exposure was.
+    '''
+    def __init__(self, cap, latency=0.0):
+        self.cap = cap
+        self.latency = latency
+
+    def read(self):
+        ret, frame = self.cap.read()
+        timestamp = time.perf_counter() - self.latency
+        if(not ret):
+            raise IOError('Could not read frame from camera')
+        return timestamp, float(np.mean(frame))
+
+class SyntheticSensor:
+    '''
+    A single pixel sensor looking at scene, a 2D array of reflectances covering
+    x_range, y_range in unit space, lit by a simulated dac (helios_sim with record=True).
+    It samples sample_rate times a second and integrates over exposure seconds
+    (default one sample period) the reflectance under the beam times its
+    brightness, plus ambient light and gaussian noise. galvo_lag delays the
+    beam position by that many samples, like real galvos that trail the
+    commanded position (which color_shifts compensate).
+    '''
+    def __init__(self, lib, scene, dac_idx=0, sample_rate=2000, exposure=None, x_range=(-1.0, 1.0),
+                 y_range=(-1.0, 1.0), xy_max=4095, max_scale=0.75, galvo_lag=0, ambient=0.0, noise=0.0, seed=0):
+        self.lib = lib
+        self.scene = np.asarray(scene, dtype=float)
+        self.dac_idx = dac_idx
+        self.sample_period = 1.0/sample_rate
+        self.exposure = self.sample_period if exposure is None else exposure
+        self.x_range = x_range
+        self.y_range = y_range
+        self.xy_max = xy_max
+        self.max_scale = max_scale
+        self.galvo_lag = galvo_lag
+        self.ambient = ambient
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.next_sample = None
+        # Every drawn point and the light it sends to the sensor, built from the recorded frames
+        self.num_frames = 0
+        self.points = np.empty(0, dtype=laser_lib.helios_point_dtype)
+        self.point_times = np.empty(0)
+        self.point_light = np.empty(0)
+        self.pps = None
+
+    def unit_position(self, points):
+        '''
+        Unit space position of dac points, inverse of the queue's position transform
+        '''
+        x = (1 - 2.0*points['x']/self.xy_max)/self.max_scale
+        y = (1 - 2.0*points['y']/self.xy_max)/self.max_scale
+        return x, y
+
+    def update_timeline(self):
+        frames = self.lib.devices[self.dac_idx].frames
+        if(len(frames) == self.num_frames):
+            return
+        new_frames = frames[self.num_frames:]
+        self.num_frames = len(frames)
+        self.pps = new_frames[-1]['pps']
+        num_old = len(self.points)
+        points = np.concatenate([frame['points'] for frame in new_frames])
+        times = np.concatenate([frame['start'] + np.arange(len(frame['points']))/frame['pps']
+                                for frame in new_frames])
+        self.points = np.concatenate([self.points, points])
+        # The beam is where the point galvo_lag samples earlier sent it
+        lagged = self.points[np.maximum(np.arange(num_old, len(self.points)) - self.galvo_lag, 0)]
+        x, y = self.unit_position(lagged)
+        height, width = self.scene.shape
+        col = np.rint((x - self.x_range[0])/(self.x_range[1] - self.x_range[0])*(width - 1)).astype(int)
+        row = np.rint((y - self.y_range[0])/(self.y_range[1] - self.y_range[0])*(height - 1)).astype(int)
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+        reflectance = np.where(inside, self.scene[np.clip(row, 0, height-1), np.clip(col, 0, width-1)], 0.0)
+        brightness = (points['r'].astype(float) + points['g'] + points['b'])/(3*255)
+        self.point_times = np.concatenate([self.point_times, times])
+        self.point_light = np.concatenate([self.point_light, reflectance*brightness])
+
+    def read(self):
+        now = time.perf_counter()
+        if(self.next_sample is None):
+            self.next_sample = now + self.sample_period
+        wait_s = self.next_sample - now
+        if(wait_s > 0):
+            time.sleep(wait_s)
+        end = self.next_sample
+        self.next_sample += self.sample_period
+        self.update_timeline()
+        # Mean light over the exposure, it is dark whenever nothing is drawn
+        light = 0.0
+        if(self.pps is not None):
+            # Frames play one after the other, so the point times are sorted
+            lo, hi = np.searchsorted(self.point_times, [end - self.exposure, end])
+            light = np.sum(self.point_light[lo:hi])/max(1.0, self.exposure*self.pps)
+        value = self.ambient + light + self.noise*self.rng.standard_normal()
+        return end - self.exposure/2, value
+
+class FlashScan(laser_lib.PointScan):
+    '''
+    The beam held at position, off for off_time and then on for on_time 
+    seconds, flashes times over. Pixel k (of num_cols = flashes) is the k-th 
+    flash, on_points the index of the first lit point of each.
+    '''
+    def __init__(self, dac_rate, position=(0.0, 0.0), flashes=5, on_time=0.5, off_time=0.5, color=(1.0, 1.0, 1.0)):
+        num_off = max(1, int(round(off_time*dac_rate)))
+        num_on = max(1, int(round(on_time*dac_rate)))
+        self.num_cols = flashes
+        self.num_rows = 1
+        lit = np.tile(np.arange(num_off + num_on) >= num_off, flashes)
+        self.arr_pos = np.tile(np.asarray(position, dtype=float), (len(lit), 1))
+        self.arr_col = np.zeros((len(lit), 3))
+        self.arr_col[lit] = color
+        self.pixel_of_point = np.where(lit, np.repeat(np.arange(flashes), num_off + num_on), -1)
+        self.on_points = np.arange(flashes)*(num_off + num_on) + num_off
+        self.num_on = num_on
+
+def measure_latency(queue, sensor, position=(0.0, 0.0), flashes=5, on_time=0.5, off_time=0.5):
+    '''
+    How many seconds late sensor's timestamps are (0 if they are right), from 
+    flashing the laser at position (somewhere the sensor sees) and comparing 
+    when each flash turns on and off with when the sensor sees it cross half 
+    way between dark and lit. A sample crosses once more than half its exposure 
+    is on the other side, which is half a sample period late on average, so that 
+    is taken off. The median over the edges is returned, to add to CameraSensor's 
+    latency (or subtract from sensor_offset). on_time and off_time have to be 
+    longer than the latency. The queue has to write on the calling thread to a 
+    single dac like for AcquisitionPipeline.
+    '''
+    if(queue.stream is not None or len(queue.dac_indices) != 1):
+        raise RuntimeError('The start of the flashes is unknown, write to a single dac without streaming')
+    dac_rate = queue.dac_rate
+    scan = FlashScan(dac_rate, position, flashes, on_time, off_time)
+    start = []
+    laser_done = threading.Event()
+    errors = []
+    def laser():
+        try:
+            scan.submit(queue, on_start=start.append)
+            queue.flush()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            laser_done.set()
+    laser_thread = threading.Thread(target=laser, name='LatencyLaser', daemon=True)
+    laser_thread.start()
+    times = []
+    values = []
+    try:
+        while(True):
+            timestamp, value = sensor.read()
+            times.append(timestamp)
+            values.append(value)
+            # Until well after the last flash went off
+            if(laser_done.is_set() and (errors or timestamp > start[0] + scan.duration(dac_rate) + off_time)):
+                break
+    finally:
+        laser_thread.join()
+    if(errors):
+        raise errors[0]
+    times = np.asarray(times)
+    values = np.asarray(values)
+    threshold = (np.percentile(values, 10) + np.percentile(values, 90))/2
+    on_times = start[0] + scan.on_points/dac_rate
+    off_times = on_times + scan.num_on/dac_rate
+    lit = values > threshold
+    delays = []
+    for edge_times, state in [(on_times, True), (off_times, False)]:
+        for edge_time in edge_times:
+            # First sample after the previous edge (half a period back) in the new state
+            crossed = np.flatnonzero((times > edge_time - min(on_time, off_time)/2) & (lit == state))
+            if(len(crossed)):
+                delays.append(times[crossed[0]] - edge_time)
+    if(not delays):
+        raise RuntimeError('The sensor did not see the flashes, point the laser where it can see it')
+    sample_period = np.median(np.diff(times)) if len(times) > 1 else 0.0
+    return float(np.median(delays) - sample_period/2)
+
+class ScanAccumulator:
+    '''
+    Running per pixel statistics of a scan, in constant memory however many
+    samples arrive. Keeps the count, mean and sum of squared deviations (m2,
+    Welford) of every pixel of shape, and how many samples were missing
+    (NaN values or None batches), in one preallocated float64 array of
+    shape (4,) + shape. With path that array is a np.memmap'ed .npy file,
+    for scans too large for memory, flush() writes it out. With resume an
+    existing file at path is opened and added to instead of overwritten.
+    Pixels without samples are NaN in mean() and variance().
+    Every export_interval seconds export_fn is called with a snapshot()
+    (on the thread that added the samples), to preview a running scan.
+    '''
+    def __init__(self, shape, path=None, export_interval=None, export_fn=None, resume=False):
+        self.shape = tuple(shape)
+        self.path = path
+        if(path is None):
+            self.data = np.zeros((4,) + self.shape)
+        elif(resume and os.path.exists(path)):
+            self.data = np.lib.format.open_memmap(path, mode='r+')
+            if(self.data.shape != (4,) + self.shape or self.data.dtype != np.float64):
+                raise ValueError(f'{path} holds {self.data.dtype} {self.data.shape[1:]}, not a {self.shape} scan')
+        else:
+            self.data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(4,) + self.shape)
+        self.export_interval = export_interval
+        self.export_fn = export_fn
+        self.lock = threading.Lock()
+        self.set_views()
+        self.samples = int(np.sum(self.counts))
+        self.dropped = 0
+        self.started = time.perf_counter()
+        self.last_export = self.started
+
+    def set_views(self):
+        # Flat views of the four planes
+        flat = self.data.reshape(4, -1)
+        self.counts, self.missing, self.means, self.m2 = flat
+        self.num_pixels = flat.shape[1]
+
+    def add(self, pixel_idx, values):
+        '''
+        Adds values to the flat pixel indices pixel_idx. Samples with a
+        negative index are dropped, NaN values are counted as missing.
+        '''
+        pixel_idx = np.asarray(pixel_idx, dtype=np.int64).ravel()
+        values = np.asarray(values, dtype=float).ravel()
+        on_pixel = (pixel_idx >= 0) & (pixel_idx < self.num_pixels)
+        finite = np.isfinite(values)
+        valid = on_pixel & finite
+        idx = pixel_idx[valid]
+        values = values[valid]
+        with self.lock:
+            self.dropped += int(np.count_nonzero(~on_pixel))
+            if(not np.all(finite[on_pixel])):
+                np.add.at(self.missing, pixel_idx[on_pixel & ~finite], 1)
+            if(len(idx)):
+                # Mean and m2 of the batch per touched pixel...
+                pixels, inverse = np.unique(idx, return_inverse=True)
+                batch_counts = np.bincount(inverse).astype(float)
+                batch_means = np.bincount(inverse, weights=values)/batch_counts
+                batch_m2 = np.bincount(inverse, weights=(values - batch_means[inverse])**2)
+                # ...merged into the running ones (Chan et al.)
+                counts = self.counts[pixels]
+                total = counts + batch_counts
+                delta = batch_means - self.means[pixels]
+                self.means[pixels] += delta*batch_counts/total
+                self.m2[pixels] += batch_m2 + delta**2*counts*batch_counts/total
+                self.counts[pixels] = total
+                self.samples += len(idx)
+        self.export()
+
+    def export(self):
+        '''
+        Calls export_fn with a snapshot() if export_interval has passed since the last one
+        '''
+        now = time.perf_counter()
+        with self.lock:
+            due = (self.export_fn is not None and self.export_interval is not None
+                   and now - self.last_export >= self.export_interval)
+            if(due):
+                self.last_export = now
+        if(due):
+            self.export_fn(self.snapshot())
+
+    def add_row(self, row, values):
+        '''
+        Adds one sample to every pixel of a row, values None marks the whole row missing
+        '''
+        num_cols = self.shape[-1]
+        if(values is None):
+            values = np.full(num_cols, np.nan)
+        self.add(row*num_cols + np.arange(num_cols), values)
+
+    def merge(self, other, pixel_offset=0):
+        '''
+        Adds the statistics of another accumulator, its pixels placed at
+        pixel_offset in this one's flat pixel index (e.g. a few rows scanned apart)
+        '''
+        pixels = slice(pixel_offset, pixel_offset + other.num_pixels)
+        with other.lock:
+            other_counts, other_missing, other_means, other_m2 = other.data.reshape(4, -1).copy()
+            other_samples, other_dropped = other.samples, other.dropped
+        with self.lock:
+            counts = self.counts[pixels]
+            total = counts + other_counts
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weight = np.where(total > 0, other_counts/total, 0.0)
+            delta = other_means - self.means[pixels]
+            self.means[pixels] += delta*weight
+            self.m2[pixels] += other_m2 + delta**2*counts*weight
+            self.counts[pixels] = total
+            self.missing[pixels] += other_missing
+            self.samples += other_samples
+            self.dropped += other_dropped
+        self.export()
+
+    def clear_rows(self, rows):
+        '''
+        Forgets everything added to rows (of a 2D shape)
+        '''
+        with self.lock:
+            self.data[:, rows] = 0
+            self.samples = int(np.sum(self.counts))
+
+    def mean(self):
+        with self.lock:
+            return np.where(self.counts > 0, self.means, np.nan).reshape(self.shape)
+
+    def variance(self):
+        '''
+        Sample variance per pixel, NaN with fewer than two samples
+        '''
+        with self.lock:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = np.where(self.counts > 1, self.m2/(self.counts - 1), np.nan)
+        return variance.reshape(self.shape)
+
+    def count(self):
+        with self.lock:
+            return self.counts.astype(np.int64).reshape(self.shape)
+
+    def snapshot(self):
+        '''
+        Copy of the image so far, the counts and the progress
+        '''
+        image = self.mean()
+        counts = self.count()
+        with self.lock:
+            pixels_done = int(np.count_nonzero(counts))
+            return {'elapsed_s': time.perf_counter() - self.started,
+                    'image': image,
+                    'counts': counts,
+                    'pixels_done': pixels_done,
+                    'progress': pixels_done/self.num_pixels,
+                    'samples': self.samples,
+                    'missing': int(np.sum(self.missing)),
+                    'dropped': self.dropped}
+
+    def flush(self):
+        if(isinstance(self.data, np.memmap)):
+            self.data.flush()
+
+def sample_pixels(scan, times, start_time, dac_rate, exposure=0.0, sensor_offset=0.0):
+    '''
+    Flat pixel index of scan lit when each sample was taken (-1 if none).
+    times are the middle of each exposure, sensor_offset is added to them
+    (a known sensor latency). Samples whose exposure (exposure seconds)
+    spans more than one pixel are dropped too.
+    '''
+    times = np.asarray(times, dtype=float) + sensor_offset
+    pixel_idx = scan.pixel_at_times(times, start_time, dac_rate)
+    if(exposure > 0):
+        # Both ends of the exposure have to be on the same pixel
+        first = scan.pixel_at_times(times - exposure/2, start_time, dac_rate)
+        last = scan.pixel_at_times(times + exposure/2 - 1e-9, start_time, dac_rate)
+        pixel_idx = np.where((first == pixel_idx) & (last == pixel_idx), pixel_idx, -1)
+    return pixel_idx
+
+def match_samples(scan, times, values, start_time, dac_rate, exposure=0.0, sensor_offset=0.0, accumulator=None):
+    '''
+    Assigns sensor samples to the pixels of scan lit when they were taken
+    (sample_pixels) and adds them to accumulator (a new ScanAccumulator by default).
+    Returns the flat pixel index of every sample (-1 if dropped) and the
+    (num_rows, num_cols) mean value and sample count per pixel.
+    '''
+    if(accumulator is None):
+        accumulator = ScanAccumulator((scan.num_rows, scan.num_cols))
+    pixel_idx = sample_pixels(scan, times, start_time, dac_rate, exposure, sensor_offset)
+    accumulator.add(pixel_idx, values)
+    return pixel_idx, accumulator.mean(), accumulator.count()
+
+class AcquisitionPipeline:
+    '''
+    Streams scan to queue on a laser thread while a capture thread reads sensor
+    and adds every batch_size samples to accumulator (a ScanAccumulator,
+    a new one by default) as soon as the start of the scan is known, so only
+    a few raw samples are held and the image can be previewed during the scan.
+    The queue has to write on the calling thread to a single dac, so the
+    start of the scan is known (see RasterScan.submit). exposure is the
+    sensor's exposure time, samples spanning two pixels are dropped.
+    '''
+    def __init__(self, queue, scan, sensor, exposure=0.0, sensor_offset=0.0, accumulator=None, batch_size=64):
+        self.queue = queue
+        self.scan = scan
+        self.sensor = sensor
+        self.exposure = exposure
+        self.sensor_offset = sensor_offset
+        if(accumulator is None):
+            accumulator = ScanAccumulator((scan.num_rows, scan.num_cols))
+        self.accumulator = accumulator
+        self.batch_size = batch_size
+        # Samples not added to the accumulator yet
+        self.times = []
+        self.values = []
+        self.start_time = None
+        self.laser_done = threading.Event()
+        self.error = None
+        self.capture_error = None
+
+    def _set_start(self, start_time):
+        self.start_time = start_time
+
+    def _laser(self):
+        try:
+            self.scan.submit(self.queue, on_start=self._set_start)
+            self.queue.flush()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.laser_done.set()
+
+    def _add_pending(self):
+        if(self.start_time is None or not self.times):
+            return
+        pixel_idx = sample_pixels(self.scan, self.times, self.start_time, self.queue.dac_rate,
+                                  self.exposure, self.sensor_offset)
+        self.accumulator.add(pixel_idx, self.values)
+        self.times = []
+        self.values = []
+
+    def _capture(self, end_time):
+        try:
+            while(True):
+                timestamp, value = self.sensor.read()
+                self.times.append(timestamp)
+                self.values.append(value)
+                if(len(self.times) >= self.batch_size):
+                    self._add_pending()
+                # Stop once the last point of the scan has been drawn
+                if(self.laser_done.is_set() and (self.error is not None or timestamp > end_time())):
+                    self._add_pending()
+                    return
+        except Exception as e:
+            # The laser error wins, the sensor failing is reported if it is the only one
+            self.capture_error = e
+
+    def run(self):
+        '''
+        Runs the scan, returns (image, counts) like match_samples
+        '''
+        # Checked before streaming the whole scan for nothing
+        if(self.queue.stream is not None or len(self.queue.dac_indices) != 1):
+            raise RuntimeError('The start of the scan is unknown, write to a single dac without streaming')
+        dac_rate = self.queue.dac_rate
+        end_time = lambda: (self.start_time if self.start_time is not None else 0.0) + self.scan.duration(dac_rate)
+        laser = threading.Thread(target=self._laser, name='AcquisitionLaser', daemon=True)
+        capture = threading.Thread(target=self._capture, args=(end_time,), name='AcquisitionCapture', daemon=True)
+        capture.start()
+        laser.start()
+        laser.join()
+        capture.join()
+        if(self.error is not None):
+            raise self.error
+        if(self.capture_error is not None):
+            raise self.capture_error
+        if(self.start_time is None):
+            raise RuntimeError('The start of the scan is unknown, write to a single dac without streaming')
+        self.accumulator.flush()
+        return self.accumulator.mean(), self.accumulator.count()
+
+if __name__ == "__main__":
+    import helios_sim
+
+    num_cols, num_rows = 40, 30
+    # Scene: a bright disc on a dim gradient, one scene pixel per scan pixel
+    yy, xx = np.mgrid[0:num_rows, 0:num_cols]
+    scene = 0.2 + 0.3*xx/num_cols + 0.5*((xx - num_cols/2)**2 + (yy - num_rows/2)**2 < (num_rows/4)**2)
+
+    lib = helios_sim.SimulatedHeliosLib()
+    queue = laser_lib.DacQueue(dac=laser_lib.Dac(lib=lib))
+    queue.dac_rate = 30000
+    # Without galvo lag the colors need no shift to line up with the positions
+    queue.color_shifts = [0, 0, 0]
+    sample_rate = 2000
+    # Four sensor samples per pixel
+    dwell = 4*queue.dac_rate//sample_rate
+    scan = laser_lib.RasterScan(num_cols, num_rows, dwell=dwell, overscan=0.05)
+    sensor = SyntheticSensor(lib, scene, sample_rate=sample_rate, xy_max=queue.dac.xy_max, max_scale=queue.max_scale)
+    # Prints the progress every half second
+    report = lambda snapshot: print(f"{snapshot['progress']*100:3.0f}% of pixels, {snapshot['samples']} samples")
+    accumulator = ScanAccumulator((num_rows, num_cols), export_interval=0.5, export_fn=report)
+    pipeline = AcquisitionPipeline(queue, scan, sensor, exposure=1.0/sample_rate, accumulator=accumulator)
+
+    start = time.perf_counter()
+    image, counts = pipeline.run()
+    duration_s = time.perf_counter() - start
+    # Lit pixels use the corrected brightness, so compare shapes not levels
+    valid = counts > 0
+    corr = np.corrcoef(image[valid], scene[valid])[0, 1]
+    print(f'{num_cols}x{num_rows} scan in {duration_s:.2f}s (scan length {scan.duration(queue.dac_rate):.2f}s), '
+          f'{np.mean(valid)*100:.0f}% of pixels sampled, {np.mean(counts[valid]):.1f} samples/pixel, '
+          f'correlation with scene {corr:.3f}')
+
+    class LateSensor:
+        '''
+        A webcam-like sensor: 30 samples a second with timestamps latency seconds late
+        '''
+        def __init__(self, sensor, latency):
+            self.sensor = sensor
+            self.latency = latency
+
+        def read(self):
+            timestamp, value = self.sensor.read()
+            return timestamp + self.latency, value
+
+    latency = 0.07
+    late = LateSensor(SyntheticSensor(lib, scene, sample_rate=30, xy_max=queue.dac.xy_max,
+                                      max_scale=queue.max_scale), latency)
+    measured = measure_latency(queue, late, flashes=6, on_time=0.25, off_time=0.25)
+    print(f'Sensor latency {latency*1e3:.0f}ms, measured {measured*1e3:.0f}ms')
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""
+Scan modes for dual photography that light fewer pixels than a full raster.
+
+AdaptiveScan (quadtree refinement) samples the corners of a coarse grid of
+blocks, then splits only the blocks whose corners differ by more than
+threshold (of the image range) and samples the corners of their quarters,
+down to single pixels. Smooth regions stay coarse and the image is
+reconstructed by bilinear interpolation inside every block.
+
+Structured patterns (single pixel imaging) light many pixels at once with
+laser_lib.PatternScan and measure the whole scene per sensor exposure.
+hadamard_patterns picks the lowest sequency 2D Walsh-Hadamard patterns, as
+complementary pairs so ambient light cancels, and reconstruct_hadamard
+inverts them with a fast transform. random_patterns and
+reconstruct_least_squares do the same for random patterns with a smoothness
+regularized least squares solve. Here the saving is in sensor exposures
+(num_measurements instead of one per pixel), not in lit points.
+
+Run this file to compare both with the scene on the simulated dac.
+"""
+
+import numpy as np
+import laser_lib
+import acquisition
+
+class AdaptiveScan:
+    '''
+    Quadtree refined scan of a num_cols x num_rows grid (like RasterScan's).
+    Blocks start start_block pixels wide and are split while the range of
+    their corner values is over threshold times the range of the image so
+    far, until min_block. block holds the size of the block every pixel is in.
+    Each round is one laser_lib.PixelScan of the new corners (dwell samples each).
+    '''
+    def __init__(self, num_cols, num_rows, x_range=(-1.0, 1.0), y_range=(-1.0, 1.0), dwell=1, start_block=8,
+                 min_block=1, threshold=0.05, transit_step=None, color=(1.0, 1.0, 1.0)):
+        if(start_block & (start_block - 1) or min_block & (min_block - 1)):
+            raise ValueError('start_block and min_block must be powers of two')
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+        self.x_range = x_range
+        self.y_range = y_range
+        self.dwell = dwell
+        self.start_block = start_block
+        self.min_block = min_block
+        self.threshold = threshold
+        self.transit_step = transit_step
+        self.color = color
+        self.block = np.full((num_rows, num_cols), start_block)
+        self.sampled = np.zeros(num_rows*num_cols, dtype=bool)
+        # Counters
+        self.rounds = 0
+        self.points_drawn = 0
+
+    def corners(self, anchor_rows, anchor_cols, size, offsets=None):
+        '''
+        Flat indices of the corners (and with offsets other points) of the
+        blocks of size at anchor_rows, anchor_cols, clipped to the grid
+        '''
+        offsets = np.array([0, size]) if offsets is None else np.asarray(offsets)
+        rows = np.minimum(anchor_rows[:, None] + offsets, self.num_rows - 1)
+        cols = np.minimum(anchor_cols[:, None] + offsets, self.num_cols - 1)
+        return (rows[:, :, None]*self.num_cols + cols[:, None, :]).ravel()
+
+    def first_pixels(self):
+        '''
+        Corners of the starting blocks
+        '''
+        size = self.start_block
+        rows, cols = np.meshgrid(np.arange(0, self.num_rows, size), np.arange(0, self.num_cols, size), indexing='ij')
+        return np.unique(self.corners(rows.ravel(), cols.ravel(), size))
+
+    def refine(self, image):
+        '''
+        Splits the blocks whose corners in image (the mean so far, NaN if not
+        sampled) differ too much. Returns the new pixels to sample.
+        '''
+        values = np.asarray(image, dtype=float).ravel()
+        if(np.all(np.isnan(values))):
+            return np.empty(0, dtype=np.int64)
+        limit = self.threshold*(np.nanmax(values) - np.nanmin(values))
+        new_pixels = []
+        for size in np.unique(self.block[self.block > self.min_block]):
+            anchor_rows, anchor_cols = np.nonzero((self.block == size) & (np.arange(self.num_rows)[:, None] % size == 0)
+                                                  & (np.arange(self.num_cols)[None, :] % size == 0))
+            corner_values = values[self.corners(anchor_rows, anchor_cols, size)].reshape(-1, 4)
+            with np.errstate(invalid='ignore'):
+                contrast = np.nanmax(corner_values, axis=1) - np.nanmin(corner_values, axis=1)
+            split = np.nan_to_num(contrast) > limit
+            if(not np.any(split)):
+                continue
+            # Mark the split blocks on a grid of blocks and scale it up to pixels
+            split_grid = np.zeros((-(-self.num_rows//size), -(-self.num_cols//size)), dtype=bool)
+            split_grid[anchor_rows[split]//size, anchor_cols[split]//size] = True
+            split_pixels = np.repeat(np.repeat(split_grid, size, axis=0), size, axis=1)[:self.num_rows, :self.num_cols]
+            self.block[split_pixels & (self.block == size)] = size//2
+            new_pixels.append(self.corners(anchor_rows[split], anchor_cols[split], size, offsets=[0, size//2, size]))
+        if(not new_pixels):
+            return np.empty(0, dtype=np.int64)
+        new_pixels = np.unique(np.concatenate(new_pixels))
+        return new_pixels[~self.sampled[new_pixels]]
+
+    def reconstruct(self, image):
+        '''
+        Full image from the sampled pixels of image: bilinear inside every
+        block between its corners (ignoring corners without samples)
+        '''
+        values = np.asarray(image, dtype=float).reshape(self.num_rows, self.num_cols)
+        rows = np.arange(self.num_rows)[:, None]
+        cols = np.arange(self.num_cols)[None, :]
+        row0 = rows//self.block*self.block
+        col0 = cols//self.block*self.block
+        row1 = np.minimum(row0 + self.block, self.num_rows - 1)
+        col1 = np.minimum(col0 + self.block, self.num_cols - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fy = np.where(row1 > row0, (rows - row0)/(row1 - row0), 0.0)
+            fx = np.where(col1 > col0, (cols - col0)/(col1 - col0), 0.0)
+        total = np.zeros(values.shape)
+        weight_sum = np.zeros(values.shape)
+        for corner_rows, corner_cols, weight in [(row0, col0, (1 - fy)*(1 - fx)), (row0, col1, (1 - fy)*fx),
+                                                 (row1, col0, fy*(1 - fx)), (row1, col1, fy*fx)]:
+            corner_values = values[corner_rows, corner_cols]
+            weight = np.where(np.isnan(corner_values), 0.0, weight)
+            total += weight*np.nan_to_num(corner_values)
+            weight_sum += weight
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight_sum > 0, total/weight_sum, np.nan)
+
+    def run(self, queue, sensor, exposure=0.0, sensor_offset=0.0, accumulator=None):
+        '''
+        Scans and refines until no block needs splitting, returns the
+        reconstructed image and the sample count per pixel
+        '''
+        if(accumulator is None):
+            accumulator = acquisition.ScanAccumulator((self.num_rows, self.num_cols))
+        pixels = self.first_pixels()
+        while(len(pixels)):
+            scan = laser_lib.PixelScan(pixels, self.num_cols, self.num_rows, x_range=self.x_range,
+                                       y_range=self.y_range, dwell=self.dwell, transit_step=self.transit_step,
+                                       color=self.color)
+            acquisition.AcquisitionPipeline(queue, scan, sensor, exposure=exposure, sensor_offset=sensor_offset,
+                                            accumulator=accumulator).run()
+            self.sampled[pixels] = True
+            self.rounds += 1
+            self.points_drawn += len(scan)
+            pixels = self.refine(accumulator.mean())
+        return self.reconstruct(accumulator.mean()), accumulator.count()
+
+    def stats(self):
+        num_sampled = int(np.sum(self.sampled))
+        return {'rounds': self.rounds,
+                'pixels_sampled': num_sampled,
+                'pixels': len(self.sampled),
+                'reduction': len(self.sampled)/max(num_sampled, 1),
+                'lit_points': num_sampled*self.dwell,
+                'points_drawn': self.points_drawn}
+
+def fwht(a, axis=-1):
+    '''
+    Unnormalized fast Walsh-Hadamard transform (Sylvester order) along axis,
+    whose length has to be a power of two
+    '''
+    a = np.moveaxis(np.array(a, dtype=float), axis, -1)
+    n = a.shape[-1]
+    if(n & (n - 1)):
+        raise ValueError(f'Length {n} is not a power of two')
+    shape = a.shape
+    h = 1
+    while(h < n):
+        # Butterflies between the two halves of every 2h long run
+        a = a.reshape(-1, n//(2*h), 2, h)
+        a = np.stack([a[:, :, 0] + a[:, :, 1], a[:, :, 0] - a[:, :, 1]], axis=2)
+        h *= 2
+    return np.moveaxis(a.reshape(shape), -1, axis)
+
+def sequency(n):
+    '''
+    Number of sign changes of every row of the n x n Sylvester Hadamard matrix
+    '''
+    hadamard = fwht(np.eye(n))
+    return np.sum(hadamard[:, 1:] != hadamard[:, :-1], axis=1)
+
+def hadamard_patterns(num_cols, num_rows, num_measurements):
+    '''
+    The num_measurements lowest sequency 2D Walsh-Hadamard patterns as
+    complementary pairs of PatternScan patterns (+1 pixels, then -1 pixels),
+    shape (2*num_measurements, num_rows, num_cols), and the (row, col)
+    coefficient index of every pair for reconstruct_hadamard
+    '''
+    row_seq = sequency(num_rows)
+    col_seq = sequency(num_cols)
+    row_idx, col_idx = np.meshgrid(np.arange(num_rows), np.arange(num_cols), indexing='ij')
+    total = row_seq[row_idx] + col_seq[col_idx]
+    peak = np.maximum(row_seq[row_idx], col_seq[col_idx])
+    order = np.lexsort((peak.ravel(), total.ravel()))[:num_measurements]
+    indices = np.column_stack([row_idx.ravel()[order], col_idx.ravel()[order]])
+    row_basis = fwht(np.eye(num_rows))[indices[:, 0]]
+    col_basis = fwht(np.eye(num_cols))[indices[:, 1]]
+    signs = row_basis[:, :, None]*col_basis[:, None, :]
+    patterns = np.empty((2*num_measurements, num_rows, num_cols), dtype=bool)
+    patterns[0::2] = signs > 0
+    patterns[1::2] = signs < 0
+    return patterns, indices
+
+def reconstruct_hadamard(measurements, indices, shape):
+    '''
+    Image from the measurements of hadamard_patterns (one per pattern, NaN
+    if missing), the minimum norm solution of the coefficients not measured
+    '''
+    measurements = np.asarray(measurements, dtype=float)
+    coefficients = np.zeros(shape)
+    coefficients[indices[:, 0], indices[:, 1]] = np.nan_to_num(measurements[0::2] - measurements[1::2])
+    return fwht(fwht(coefficients, axis=0), axis=1)/(shape[0]*shape[1])
+
+def random_patterns(num_cols, num_rows, num_measurements, seed=0):
+    '''
+    num_measurements random +-1 patterns as complementary pairs like
+    hadamard_patterns, and their (num_measurements, num_pixels) sign matrix
+    '''
+    rng = np.random.default_rng(seed)
+    signs = rng.choice([-1.0, 1.0], size=(num_measurements, num_rows*num_cols))
+    patterns = np.empty((2*num_measurements, num_rows, num_cols), dtype=bool)
+    patterns[0::2] = (signs > 0).reshape(-1, num_rows, num_cols)
+    patterns[1::2] = (signs < 0).reshape(-1, num_rows, num_cols)
+    return patterns, signs
+
+def reconstruct_least_squares(measurements, signs, shape, smoothness=0.1, iterations=200, tolerance=1e-6):
+    '''
+    Image x minimizing |signs x - y|^2 + smoothness |gradient x|^2 for the
+    measurements of random_patterns (or any pattern pairs with their sign
+    matrix), solved with conjugate gradients. Missing (NaN) pairs are left out.
+    '''
+    measurements = np.asarray(measurements, dtype=float)
+    y = measurements[0::2] - measurements[1::2]
+    valid = np.isfinite(y)
+    signs = signs[valid]
+    y = y[valid]
+    # Scaled so smoothness does not depend on the number of measurements
+    scale = 1.0/max(len(y), 1)
+
+    def gradient_normal(x):
+        # D^T D x of the horizontal and vertical differences
+        image = x.reshape(shape)
+        result = np.zeros(shape)
+        dy = np.diff(image, axis=0)
+        dx = np.diff(image, axis=1)
+        result[:-1] -= dy
+        result[1:] += dy
+        result[:, :-1] -= dx
+        result[:, 1:] += dx
+        return result.ravel()
+
+    def normal(x):
+        return scale*(signs.T @ (signs @ x)) + smoothness*gradient_normal(x)
+
+    x = np.zeros(shape[0]*shape[1])
+    residual = scale*(signs.T @ y)
+    direction = residual.copy()
+    residual_norm = residual @ residual
+    start_norm = residual_norm
+    for _ in range(iterations):
+        if(residual_norm <= tolerance**2*start_norm):
+            break
+        product = normal(direction)
+        step = residual_norm/(direction @ product)
+        x += step*direction
+        residual -= step*product
+        new_norm = residual @ residual
+        direction = residual + new_norm/residual_norm*direction
+        residual_norm = new_norm
+    return x.reshape(shape)
+
+def measure_patterns(queue, sensor, patterns, x_range=(-1.0, 1.0), y_range=(-1.0, 1.0), dwell=1, repeats=3,
+                     sensor_offset=0.0):
+    '''
+    Draws patterns with a PatternScan and returns the mean sensor value per
+    pattern (NaN if no exposure fit inside one). The sensor's exposure has
+    to be one period of the scan, pattern_exposure tells how long that is.
+    '''
+    scan = laser_lib.PatternScan(patterns, x_range=x_range, y_range=y_range, dwell=dwell, repeats=repeats)
+    pipeline = acquisition.AcquisitionPipeline(queue, scan, sensor, exposure=scan.period/queue.dac_rate,
+                                               sensor_offset=sensor_offset)
+    image, _ = pipeline.run()
+    return image.ravel()
+
+def pattern_exposure(patterns, dac_rate, dwell=1):
+    '''
+    Exposure time (one period) a sensor needs for measure_patterns of patterns
+    '''
+    return laser_lib.PatternScan(patterns, dwell=dwell, repeats=1).period/dac_rate
+
+if __name__ == "__main__":
+    import time
+    import helios_sim
+
+    def scene_image(size):
+        # Piecewise smooth: a gradient, a bright disc and a dark square
+        yy, xx = np.mgrid[0:size, 0:size]/size
+        scene = 0.3 + 0.2*xx + 0.4*((xx - 0.4)**2 + (yy - 0.5)**2 < 0.2**2)
+        scene[int(0.6*size):int(0.85*size), int(0.6*size):int(0.85*size)] = 0.05
+        return scene
+
+    def correlation(image, scene):
+        valid = np.isfinite(image)
+        return np.corrcoef(image[valid], scene[valid])[0, 1]
+
+    def make_queue():
+        lib = helios_sim.SimulatedHeliosLib()
+        queue = laser_lib.DacQueue(dac=laser_lib.Dac(lib=lib))
+        queue.dac_rate = 30000
+        queue.color_shifts = [0, 0, 0]
+        return lib, queue
+
+    # Adaptive scan against the number of pixels of a full raster
+    size = 64
+    scene = scene_image(size)
+    lib, queue = make_queue()
+    sample_rate = 2000
+    sensor = acquisition.SyntheticSensor(lib, scene, sample_rate=sample_rate, xy_max=queue.dac.xy_max,
+                                         max_scale=queue.max_scale)
+    adaptive = AdaptiveScan(size, size, dwell=4*queue.dac_rate//sample_rate, start_block=8, threshold=0.05)
+    start = time.perf_counter()
+    image, counts = adaptive.run(queue, sensor, exposure=1.0/sample_rate)
+    stats = adaptive.stats()
+    print(f"Adaptive {size}x{size}: {stats['pixels_sampled']} of {stats['pixels']} pixels in {stats['rounds']} rounds "
+          f"({stats['reduction']:.1f}x fewer lit points), {time.perf_counter() - start:.1f}s, "
+          f"correlation with scene {correlation(image, scene):.3f}")
+
+    # Structured patterns, a quarter as many measurements as pixels
+    size = 16
+    scene = scene_image(size)
+    num_measurements = size*size//4
+    dwell = 2
+    for name, (patterns, extra) in [('Hadamard', hadamard_patterns(size, size, num_measurements)),
+                                    ('Random', random_patterns(size, size, num_measurements))]:
+        lib, queue = make_queue()
+        exposure = pattern_exposure(patterns, queue.dac_rate, dwell=dwell)
+        sensor = acquisition.SyntheticSensor(lib, scene, sample_rate=1.0/exposure, exposure=exposure,
+                                             xy_max=queue.dac.xy_max, max_scale=queue.max_scale)
+        start = time.perf_counter()
+        measurements = measure_patterns(queue, sensor, patterns, dwell=dwell)
+        if(name == 'Hadamard'):
+            image = reconstruct_hadamard(measurements, extra, (size, size))
+        else:
+            image = reconstruct_least_squares(measurements, extra, (size, size))
+        print(f'{name} {size}x{size}: {len(patterns)} exposures for {size*size} pixels, '
+              f'{time.perf_counter() - start:.1f}s, correlation with scene {correlation(image, scene):.3f}')
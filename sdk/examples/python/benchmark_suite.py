@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for laser_lib, with JSON output for comparing changes.
+
+Times prep_pattern packing (also through the pattern cache, hits and misses),
+color_correction, connect_in_space, fixed_interp, DacQueue.submit (with gap
+generation) and sustained streaming, across point counts and dac rates, and
+reports p50/p99 latency per call. Uses a real DAC
+if one is found, otherwise the simulated library (helios_sim).
+
+    python benchmark_suite.py --out results.json
+    python benchmark_suite.py --baseline results.json --tolerance 0.2
+
+With --baseline the exit code is 1 if any p50 got slower by more than the tolerance.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import laser_lib
+import helios_sim
+
+def percentile_summary(times_s):
+    '''
+    Latency summary of a list of call times, in microseconds
+    '''
+    times_us = np.asarray(times_s)*1e6
+    return {'reps': len(times_us),
+            'mean_us': float(np.mean(times_us)),
+            'p50_us': float(np.percentile(times_us, 50)),
+            'p99_us': float(np.percentile(times_us, 99)),
+            'max_us': float(np.max(times_us))}
+
+def time_calls(fn, reps, warmup=2):
+    '''
+    Calls fn reps times (after warmup calls) and returns the time of each call
+    '''
+    for _ in range(warmup):
+        fn()
+    times_s = []
+    for _ in range(reps):
+        start_time = time.perf_counter()
+        fn()
+        times_s.append(time.perf_counter() - start_time)
+    return times_s
+
+def make_dac(backend):
+    '''
+    Dac on the requested backend, 'auto' picks usb if a DAC is connected
+    '''
+    if(backend == 'auto'):
+        try:
+            lib = laser_lib.load_backend('usb')
+            if(lib.OpenDevices() > 0):
+                return laser_lib.Dac(lib=lib), 'usb'
+        except OSError:
+            pass
+        backend = 'sim'
+    if(backend == 'sim'):
+        return laser_lib.Dac(lib=helios_sim.SimulatedHeliosLib(record=False)), 'sim'
+    return laser_lib.Dac(backend=backend), backend
+
+def random_pattern(rng, num_points):
+    arr_pos = rng.random((num_points, 2))*2 - 1
+    arr_col = rng.random((num_points, 3))
+    return arr_pos, arr_col
+
+def bench_prep_pattern(queue, rng, num_points, reps):
+    arr_pos, arr_col = random_pattern(rng, num_points)
+    out = np.empty(num_points, dtype=laser_lib.helios_point_dtype)
+    return time_calls(lambda: queue.prep_pattern(arr_pos, arr_col, out=out), reps)
+
+def bench_prep_pattern_cache_hit(queue, rng, num_points, reps):
+    # The same pattern and cache_key every call
+    arr_pos, arr_col = random_pattern(rng, num_points)
+    out = np.empty(num_points, dtype=laser_lib.helios_point_dtype)
+    return time_calls(lambda: queue.prep_pattern(arr_pos, arr_col, out=out, cache_key='pattern'), reps)
+
+def bench_prep_pattern_cache_miss(queue, rng, num_points, reps):
+    # A new cache_key every call, so every call packs and stores the pattern
+    arr_pos, arr_col = random_pattern(rng, num_points)
+    out = np.empty(num_points, dtype=laser_lib.helios_point_dtype)
+    keys = iter(range(reps + 2))
+    return time_calls(lambda: queue.prep_pattern(arr_pos, arr_col, out=out, cache_key=next(keys)), reps)
+
+def bench_color_correction(queue, rng, num_points, reps):
+    _, arr_col = random_pattern(rng, num_points)
+    color_shifts = queue.active_color_shifts()
+    return time_calls(lambda: laser_lib.color_correction(arr_col, color_shifts=color_shifts), reps)
+
+def bench_connect_in_space(queue, rng, num_points, reps):
+    # Ten segments of equal length
+    arr_pos_list = [random_pattern(rng, max(1, num_points//10))[0] for _ in range(10)]
+    return time_calls(lambda: laser_lib.connect_in_space(arr_pos_list), reps)
+
+def bench_fixed_interp(queue, rng, num_points, reps):
+    # Ten interp points between each pair of anchors
+    anchors = random_pattern(rng, max(2, num_points//10))[0]
+    return time_calls(lambda: laser_lib.fixed_interp(anchors, 10), reps)
+
+def bench_submit(queue, rng, num_points, reps):
+    # A new pattern every submit so the gap is exercised
+    patterns = [random_pattern(rng, num_points) for _ in range(reps + 2)]
+    patterns_iter = iter(patterns)
+    return time_calls(lambda: queue.submit(*next(patterns_iter)), reps)
+
+def bench_streaming(queue, rng, num_points, reps):
+    patterns = [random_pattern(rng, num_points) for _ in range(reps + 2)]
+    patterns_iter = iter(patterns)
+    queue.start_streaming()
+    stream = queue.stream
+    start_time = time.perf_counter()
+    try:
+        times_s = time_calls(lambda: queue.submit(*next(patterns_iter)), reps)
+    finally:
+        queue.stop_streaming()
+    # Sustained rate including draining the stream, and how often it ran empty
+    duration_s = time.perf_counter() - start_time
+    stream_stats = stream.stats()
+    return times_s, {'sustained_points_per_sec': stream_stats['frames_sent']/duration_s*num_points,
+                     'underruns': stream_stats['underruns']}
+
+# name, function, uses the dac, pattern cache_bytes
+BENCHMARKS = [('prep_pattern', bench_prep_pattern, False, 0),
+              ('prep_pattern_cache_hit', bench_prep_pattern_cache_hit, False, 32*2**20),
+              ('prep_pattern_cache_miss', bench_prep_pattern_cache_miss, False, 32*2**20),
+              ('color_correction', bench_color_correction, False, 0),
+              ('connect_in_space', bench_connect_in_space, False, 0),
+              ('fixed_interp', bench_fixed_interp, False, 0),
+              ('submit', bench_submit, True, 0),
+              ('streaming', bench_streaming, True, 0)]
+
+def run_suite(dac, point_counts, dac_rates, reps, device_reps, names=None):
+    rng = np.random.default_rng(0)
+    results = []
+    for name, bench_fn, uses_dac, cache_bytes in BENCHMARKS:
+        if(names and name not in names):
+            continue
+        for dac_rate in dac_rates:
+            for num_points in point_counts:
+                # Fresh queue per case, so the cache starts empty
+                queue = laser_lib.DacQueue(dac=dac, cache_bytes=cache_bytes)
+                queue.dac_rate = dac_rate
+                queue.color_latency_us = [150, 150, 120]
+                start_time = time.perf_counter()
+                times_s = bench_fn(queue, rng, num_points, device_reps if uses_dac else reps)
+                duration_s = time.perf_counter() - start_time
+                # Benchmarks may return extra numbers next to the call times
+                extra = {}
+                if(isinstance(times_s, tuple)):
+                    times_s, extra = times_s
+                result = {'name': name, 'points': num_points, 'dac_rate': dac_rate}
+                result.update(percentile_summary(times_s))
+                result['points_per_sec'] = len(times_s)*num_points/sum(times_s)
+                result.update(extra)
+                results.append(result)
+                print(f"{name:23s} points={num_points:5d} rate={dac_rate:6d} "
+                      f"p50={result['p50_us']:10.1f}us p99={result['p99_us']:10.1f}us ({duration_s:.2f}s)")
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the cases whose p50 is more than tolerance slower than in baseline
+    '''
+    baseline_p50 = {(r['name'], r['points'], r['dac_rate']): r['p50_us'] for r in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (result['name'], result['points'], result['dac_rate'])
+        if(key in baseline_p50 and result['p50_us'] > baseline_p50[key]*(1 + tolerance)):
+            regressions.append({'case': key, 'p50_us': result['p50_us'], 'baseline_p50_us': baseline_p50[key]})
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', default='auto', choices=['auto', 'usb', 'sim'])
+    parser.add_argument('--points', default='100,1000,4096', help='comma separated point counts')
+    parser.add_argument('--rates', default='30000,65000', help='comma separated dac rates')
+    parser.add_argument('--reps', type=int, default=200, help='calls per case')
+    parser.add_argument('--device-reps', type=int, default=10, help='calls per case that write to the dac')
+    parser.add_argument('--only', default='', help='comma separated benchmark names')
+    parser.add_argument('--out', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p50 slowdown vs baseline')
+    args = parser.parse_args()
+
+    dac, backend = make_dac(args.backend)
+    point_counts = [int(n) for n in args.points.split(',')]
+    dac_rates = [int(rate) for rate in args.rates.split(',')]
+    names = [name for name in args.only.split(',') if name]
+    results = run_suite(dac, point_counts, dac_rates, args.reps, args.device_reps, names)
+
+    report = {'meta': {'backend': backend,
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'machine': platform.machine(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'args': vars(args)},
+              'results': results}
+    if(args.out):
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression:', regression)
+        if(regressions):
+            sys.exit(1)
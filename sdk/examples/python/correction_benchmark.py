@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for turning unit space patterns into packed DAC points.
+
+Compares the separate position_corection / color_correction / pack_frame
+steps against the FusedTransform used by DacQueue.prep_pattern: time per
+frame and the peak memory allocated per frame (numpy allocations are visible
+to tracemalloc). Does not need a DAC or the Helios library.
+"""
+
+import time
+import tracemalloc
+import numpy as np
+import laser_lib
+
+xy_max = int(2**12-1)
+color_shifts = [5, 5, 4]
+
+def separate_steps(arr_pos, arr_col, out):
+    '''
+    What prep_pattern did before the fused transform
+    '''
+    arr_pos = arr_pos.copy()
+    arr_col = arr_col.copy()
+    arr_pos = laser_lib.position_corection(arr_pos)
+    arr_pos = (((arr_pos+1)/2.0)*xy_max).astype(np.int32)
+    arr_col = laser_lib.color_correction(arr_col, color_shifts=color_shifts)
+    arr_col = (arr_col*255).astype(np.int32)
+    return laser_lib.pack_frame(arr_pos, arr_col)
+
+def fused_steps(arr_pos, arr_col, out, transform=laser_lib.FusedTransform()):
+    return transform.apply(arr_pos, arr_col, out, xy_max, color_shifts=color_shifts)
+
+def time_per_frame(fn, arr_pos, arr_col, out, reps=500):
+    start_time = time.perf_counter()
+    for _ in range(reps):
+        fn(arr_pos, arr_col, out)
+    return (time.perf_counter() - start_time)/reps
+
+def peak_bytes_per_frame(fn, arr_pos, arr_col, out, reps=50):
+    '''
+    Largest amount of memory allocated on top of what was live while packing one frame
+    '''
+    # Warm up so scratch buffers already exist
+    fn(arr_pos, arr_col, out)
+    tracemalloc.start()
+    peak = 0
+    for _ in range(reps):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(arr_pos, arr_col, out)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return peak
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for num_points in [100, 1000, 4096]:
+        arr_pos = rng.random((num_points, 2))*2 - 1
+        arr_col = rng.random((num_points, 3))
+        out = np.empty(num_points, dtype=laser_lib.helios_point_dtype)
+
+        # Both paths must produce the same bytes
+        assert bytes(separate_steps(arr_pos, arr_col, out)[0]) == fused_steps(arr_pos, arr_col, out).tobytes()
+
+        for name, fn in [('Separate', separate_steps), ('Fused', fused_steps)]:
+            frame_time = time_per_frame(fn, arr_pos, arr_col, out)
+            peak = peak_bytes_per_frame(fn, arr_pos, arr_col, out)
+            print(f'NumPoints: {num_points}\t{name}: {frame_time*1e6:.1f}us/frame\tPeakAlloc: {peak:,} bytes')
@@ -7,6 +7,9 @@
 # which measures the light from the laser as it scans across a scene.
 
 import laser_lib
+import acquisition
+import scan_job
+import adaptive_scan
 import numpy as np
 import math
 import time
@@ -99,52 +102,56 @@ if __name__ == "__main__":
         x_min = -1.0
         x_max = 1.0
         queue.dac_rate = 10000
-        T = 100  # Points in a single scan line
-        T_rew = T*10 # Points for the rewind path
-        
-        # Define the laser path for a single line scan (left to right)
-        arr_pos = np.zeros((T, 2))
-        arr_pos[:, 0] = np.linspace(x_max, x_min, T)
-        arr_col = np.ones((T, 3)) # Laser ON
-
-        # Define the laser path for the rewind (right to left)
-        arr_pos_rew = np.zeros((T_rew, 2))
-        arr_pos_rew[:, 0] = np.linspace(x_min, x_max, T_rew)
-        arr_col_rew = np.zeros((T_rew, 3)) # Laser OFF
 
         #num_lines = 80 # Vertical and horizontal resolution of the final image
         num_lines = 200 # Vertical and horizontal resolution of the final image
-        
-        lines_y = np.linspace(y_max, y_min, num_lines)
-        lines_x = np.linspace(x_max, x_min, num_lines)
-        raw_img_arr = []
-
-        print("\nStarting scene scan...")
-        # --- Main Scanning Loop ---
-        for idx_y, y in enumerate(lines_y):
-            line_arr = []
-            
-            for idx_x, x in enumerate(lines_x):
-                print(f"Scanning {idx_x + 1}/{num_lines}   {idx_y + 1}/{num_lines}", end='\r')
-                arr_pos[:, 0] = x
-                arr_pos[:, 1] = y
-                arr_pos_rew[:, 1] = y
-
-                # Move to the next point
-                queue.submit(arr_pos, arr_col, loop=True)
-                # Get the brightness
-                brightness = sample_camera(cap)
-                line_arr.append(brightness)
-
-            # Rewind the galvos
-            queue.submit(arr_pos_rew, arr_col_rew)
-            raw_img_arr.append(line_arr)
-            print('\n\n')
-                
+        # 'raster' scans every pixel, 'adaptive' refines a coarse grid (adaptive_scan.py)
+        scan_mode = 'raster'
+        # How late the webcam's frames are, in seconds. Samples are matched to pixels by 
+        # time, so a typical 1-3 frame latency would shift every row by pixels (opposite 
+        # ways on alternate rows). None measures it first by flashing the laser at the 
+        # center of the scene, which the camera has to see.
+        camera_latency = None
+
+        # The laser streams the raster while the camera keeps capturing,
+        # each pixel is lit for two camera frames so one exposure falls fully on it
+        camera_fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        dwell = int(2*queue.dac_rate/camera_fps)
+        params = {'num_cols': num_lines, 'num_rows': num_lines, 'x_range': (x_max, x_min),
+                  'y_range': (y_max, y_min), 'dwell': dwell, 'overscan': 0.05,
+                  'dac_rate': queue.dac_rate, 'exposure': 1.0/camera_fps}
+        # Progress of the running mean image every 30 seconds
+        report = lambda snapshot: print(f"{snapshot['progress']*100:.1f}% of pixels sampled "
+                                        f"after {snapshot['elapsed_s']/60:.1f} minutes")
+        if(camera_latency is None):
+            print("\nMeasuring the camera latency...")
+            camera_latency = acquisition.measure_latency(queue, acquisition.CameraSensor(cap))
+            print(f"Camera latency {camera_latency*1e3:.0f}ms ({camera_latency*camera_fps:.1f} frames)")
+        sensor = acquisition.CameraSensor(cap, latency=camera_latency)
+
+        if(scan_mode == 'adaptive'):
+            # Refines only where the image changes, not resumable
+            adaptive = adaptive_scan.AdaptiveScan(num_lines, num_lines, x_range=(x_max, x_min), y_range=(y_max, y_min),
+                                                  dwell=dwell, start_block=8, threshold=0.05)
+            print("\nStarting adaptive scene scan...")
+            img, counts = adaptive.run(queue, sensor, exposure=1.0/camera_fps)
+            print(adaptive.stats())
+        else:
+            # Results go to disk as the scan runs, running the script again after
+            # a crash continues from the last completed line of the same scan
+            job_path = scan_job.job_path('dual_photography_jobs', params)
+            job = scan_job.ScanJob(job_path, params, rows_per_chunk=5, export_interval=30.0, export_fn=report)
+            if(job.done):
+                print(f"The scan in {job_path} is complete, scanning again")
+                job.reset()
+            elif(job.resumed):
+                print(f"Resuming the scan in {job_path}: {job.stats()['rows_done']} of {num_lines} lines done")
+            print(f"\nStarting scene scan ({job.duration()/60:.1f} minutes)...")
+            img, counts = job.run(queue, sensor)
+        print(f"{np.mean(counts > 0)*100:.0f}% of pixels sampled")
 
         print("\n✅ Scan complete. Processing image...")
         
-        img = np.stack(raw_img_arr, axis=0)
         print(f"Image processed. Final shape: {img.shape}")
 
 
@@ -23,6 +23,8 @@ queue = laser_lib.DacQueue()
 
 import serial
 import time
+import photodiode
+import acquisition
 
 # --- CONFIGURABLE PARAMETERS ---
 
@@ -35,54 +37,44 @@ BAUD_RATE = 9600
 # This must match the 'dataPoints' variable in your Arduino script.
 NUM_POINTS_PER_BATCH = 100
 
+# 'ascii' for the sketch printing one number per line. 'binary' only for a
+# sketch sending each batch as one frame with sendFrame (see photodiode.py),
+# with the ascii sketch every batch times out as None.
+PROTOCOL = 'ascii'
+
 # The reference voltage of your Arduino (usually 5.0V).
 REFERENCE_VOLTAGE = 5.0
 
 # --- END OF PARAMETERS ---
 
 
-def get_arduino_batch(ser, num_points, ref_voltage):
+def make_parser():
+    if(PROTOCOL == 'binary'):
+        return photodiode.FrameParser()
+    return photodiode.AsciiParser()
+
+
+def get_arduino_batch(reader, num_points, ref_voltage):
     """
-    Listens for and receives a single, complete batch of data from the Arduino.
+    Receives a single, complete batch of data from the Arduino.
 
-    This function waits for the Arduino's "sending data" signal, then reads
-    the specified number of data points, converts them to voltage, and
-    returns them as a list of floats.
+    The samples are read in bulk on a background thread (photodiode.PhotodiodeReader).
+    Corrupt or lost binary frames and ascii lines that fail to parse come
+    back as NaN samples in their place, so the batch stays aligned with the scan.
 
     Args:
-        ser (serial.Serial): An active, open pyserial connection object.
+        reader (photodiode.PhotodiodeReader): A started reader on the open serial port.
         num_points (int): The number of data points to expect in the batch.
         ref_voltage (float): The Arduino's reference voltage for conversion.
 
     Returns:
-        list: A list of floating-point voltage values, or None if an error occurs.
+        np.ndarray: The voltage values (NaN where missing), or None if the batch did not arrive in time.
     """
-    # # Wait until we receive the Arduino's signal that it's sending data.
-    # while True:
-    #     line = ser.readline().decode('utf-8').strip()
-    #     if "Sending data to computer" in line:
-    #         print(f"\nIncoming data batch detected at {time.strftime('%H:%M:%S')}...")
-    #         break # Exit the waiting loop and proceed to read data.
-
-    # Now, read the exact number of data points we expect.
-    batch_data = []
-    for _ in range(num_points):
-        try:
-            # Read the next line, which should be a number.
-            data_line = ser.readline().decode('utf-8').strip()
-            
-            # Convert the raw integer string (0-1023) to a floating-point voltage.
-            raw_value = int(data_line)
-            voltage = (raw_value / 1023.0) * ref_voltage
-            batch_data.append(voltage)
-        
-        except (ValueError, IndexError):
-            # Handle cases where a line is not a valid number or is empty.
-            print(f"⚠️ Warning: Could not parse a data point. Adding None as a placeholder.", data_line)
-            batch_data.append(None)
-            return None
-            
-    return batch_data
+    values, _ = reader.read(num_points, timeout=2)
+    if(len(values) < num_points):
+        print(f"⚠️ Warning: Only {len(values)} of {num_points} data points arrived.", reader.stats())
+        return None
+    return photodiode.to_voltage(values, ref_voltage)
 
 
 def main():
@@ -94,15 +86,16 @@ def main():
     try:
         # Establish the serial connection. The 'with' statement ensures it's closed properly.
         print(f"Attempting to connect to {SERIAL_PORT} at {BAUD_RATE} baud...")
-        with serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=2) as ser:
+        with serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=2) as ser, \
+             photodiode.PhotodiodeReader(ser, parser=make_parser()) as reader:
             print(f"✅ Connection successful! Waiting for data...")
             
             # This loop will run forever, getting one batch at a time.
             while True:
                 # Call the function to get the next batch.
-                new_batch = get_arduino_batch(ser, NUM_POINTS_PER_BATCH, REFERENCE_VOLTAGE)
+                new_batch = get_arduino_batch(reader, NUM_POINTS_PER_BATCH, REFERENCE_VOLTAGE)
                 
-                if new_batch:
+                if new_batch is not None:
                     all_data.append(new_batch)
                     print(f"✅ Batch received. Total batches collected: {len(all_data)}")
                     # Print the first 5 values of the new batch as a preview
@@ -186,12 +179,13 @@ arr_pos_rew[:, 0] = np.linspace(xy_min, xy_max, T_rew)
 num_lines = 100
 samples_per_line = 10
 lines_y = np.linspace(xy_max, xy_min, num_lines)
-line_arr = []
-with serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=2) as ser:
+# Running mean per line and batch position, missing batches are masked
+results = acquisition.ScanAccumulator((num_lines, NUM_POINTS_PER_BATCH))
+with serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=2) as ser, \
+     photodiode.PhotodiodeReader(ser, parser=make_parser()) as reader:
     print(f"✅ Connection successful! Waiting for data...")
     # while(True):
     for idx, y in enumerate(lines_y):
-        samples_arr = []
         for sample in range(samples_per_line):
             print(sample, idx, end='\r')
             # Scan left to right
@@ -202,28 +196,18 @@ with serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=2) as ser:
             for i in range(1):
                 queue.submit(arr_pos_rew, arr_col_rew)
             print('Getting batch: ')
-            batch = get_arduino_batch(ser, 100, 5.0)
-            samples_arr.append(batch)
+            batch = get_arduino_batch(reader, NUM_POINTS_PER_BATCH, REFERENCE_VOLTAGE)
+            results.add_row(idx, batch)
             print('Batch: ', batch)
-        line_arr.append(samples_arr)
 
 
 # In[51]:
 
 
-smoothed = []
-for idx, samples_arr in enumerate(line_arr):
-    print('sample: ', idx, '/', len(line_arr))
-    samples = [s for s in samples_arr if s]
-    print(len(samples))
-    if(len(samples) < 1):
-        continue
-    stack = np.stack(samples, axis=0)
-    smooth = np.mean(stack, axis=0)
-    print(stack.shape, smooth.shape)
-    smoothed.append(smooth)
-print('Done: ', len(smoothed), len(smoothed[0]))
-img = np.stack(smoothed, axis=1)
+snapshot = results.snapshot()
+print('Done: ', snapshot['pixels_done'], 'pixels,', snapshot['missing'], 'missing samples')
+# One column per line, lines without any batch are NaN
+img = results.mean().T
 print(img.shape)
 
 
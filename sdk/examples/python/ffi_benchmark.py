@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the ctypes call overhead of GetStatus and WriteFrame.
+
+Compares calling the library the old way (attribute lookup and ctypes.pointer
+on every call) with the prototyped functions of laser_lib.load_library and the
+bound hot path functions Dac uses for every frame (laser_lib.hot_path_functions).
+Also times loading the library per Dac against the per-process cache.
+
+Needs no DAC: if libHeliosDacAPI.so cannot be loaded (or with --stub) a stub
+library with the same functions is compiled with cc, so only the FFI cost is
+measured.
+"""
+
+import argparse
+import ctypes
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+import laser_lib
+
+STUB_SOURCE = r'''
+#include <stdint.h>
+typedef struct { uint16_t x; uint16_t y; uint8_t r; uint8_t g; uint8_t b; uint8_t i; } HeliosPoint;
+int OpenDevices() { return 1; }
+int CloseDevices() { return 1; }
+int GetStatus(unsigned int dacNum) { return 1; }
+int WriteFrame(unsigned int dacNum, int pps, uint8_t flags, HeliosPoint* points, int numOfPoints)
+{ return points[numOfPoints-1].i ? 1 : 1; }
+int SetShutter(unsigned int dacNum, _Bool value) { return 1; }
+int Stop(unsigned int dacNum) { return 1; }
+'''
+
+def build_stub(directory):
+    '''
+    Compiles the stub library into directory and returns its path
+    '''
+    source_path = os.path.join(directory, 'helios_stub.c')
+    lib_path = os.path.join(directory, 'libHeliosStub.so')
+    with open(source_path, 'w') as f:
+        f.write(STUB_SOURCE)
+    subprocess.check_call(['cc', '-O2', '-shared', '-fPIC', '-o', lib_path, source_path])
+    return lib_path
+
+def calls_per_second(fn, min_time=0.5):
+    reps = 0
+    start_time = time.perf_counter()
+    while(True):
+        for _ in range(1000):
+            fn()
+        reps += 1000
+        duration_s = time.perf_counter() - start_time
+        if(duration_s > min_time):
+            break
+    return reps/duration_s
+
+def run(lib_path, num_points):
+    points, _ = laser_lib.pack_frame(np.zeros((num_points, 2), dtype=np.int32),
+                                     np.zeros((num_points, 3), dtype=np.int32))
+    # A separate handle so the prototypes of load_library do not apply
+    generic = ctypes.CDLL(lib_path)
+    prototyped = laser_lib.load_library(lib_path)
+    write_frame, get_status = laser_lib.hot_path_functions(prototyped)
+
+    results = [('GetStatus', 'generic', lambda: generic.GetStatus(0)),
+               ('GetStatus', 'prototyped', lambda: prototyped.GetStatus(0)),
+               ('GetStatus', 'hot path', lambda: get_status(0)),
+               ('WriteFrame', 'generic', lambda: generic.WriteFrame(0, 30000, 0, ctypes.pointer(points), num_points)),
+               ('WriteFrame', 'prototyped', lambda: prototyped.WriteFrame(0, 30000, 0, points, num_points)),
+               ('WriteFrame', 'hot path', lambda: write_frame(0, 30000, 0, points, num_points))]
+    for call, name, fn in results:
+        print(f'{call:10s} {name:10s}: {calls_per_second(fn):12,.0f} calls/s')
+
+    for name, load_fn in [('LoadLibrary', lambda: ctypes.cdll.LoadLibrary(lib_path)),
+                          ('load_library', lambda: laser_lib.load_library(lib_path))]:
+        print(f'{name:21s}: {calls_per_second(load_fn, min_time=0.2):12,.0f} loads/s')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stub', action='store_true', help='always use the compiled stub library')
+    parser.add_argument('--points', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        lib_path = os.path.abspath('./libHeliosDacAPI.so')
+        try:
+            if(args.stub):
+                raise OSError('stub requested')
+            ctypes.CDLL(lib_path)
+        except OSError as e:
+            print(f'Using a stub library ({e})')
+            lib_path = build_stub(directory)
+        run(lib_path, args.points)
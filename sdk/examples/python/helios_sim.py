@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-in for libHeliosDacAPI, for running laser_lib without a DAC.
+
+SimulatedHeliosLib has the same calls as the ctypes library (OpenDevices,
+GetStatus, WriteFrame, SetShutter, Stop, CloseDevices) and the same return
+codes (HeliosDac.h). Each simulated dac is double buffered: a written frame
+waits until the playing one is done (or starts right away with the start
+immediately flag), GetStatus is 1 once the waiting slot is free again, and a
+frame plays for num_points/pps seconds. Like the real library, WriteFrame
+returns DEVICE_FRAME_READY while the waiting slot is taken (with
+block_writes it waits for the slot instead), and blocks for the USB
+transfer time of the frame. Frames are recorded so
+tests and benchmarks can check what would have been drawn.
+
+Faults can be injected: disconnect() unplugs a dac (its calls return
+DEVICE_CLOSED until it is reopened after down_for seconds) and fail_next()
+makes the next calls of a function return an error code.
+
+Use it with laser_lib.Dac(lib=SimulatedHeliosLib()), Dac(backend='sim') or
+by setting HELIOS_BACKEND=sim.
+"""
+
+import ctypes
+import threading
+import time
+import math
+import numpy as np
+import laser_lib
+from laser_lib import (HELIOS_SUCCESS, HELIOS_ERROR_NOT_INITIALIZED, HELIOS_ERROR_INVALID_DEVNUM, 
+                       HELIOS_ERROR_NULL_POINTS, HELIOS_ERROR_TOO_MANY_POINTS, HELIOS_ERROR_PPS_TOO_HIGH, 
+                       HELIOS_ERROR_PPS_TOO_LOW, HELIOS_ERROR_DEVICE_CLOSED, HELIOS_ERROR_DEVICE_FRAME_READY,
+                       HELIOS_MAX_RATE, HELIOS_MIN_RATE)
+
+HELIOS_FLAGS_START_IMMEDIATELY = 1 << 0
+HELIOS_FLAGS_SINGLE_MODE = 1 << 1
+
+# Bytes per point on the wire and the pps/count/flags trailer (HeliosDacDevice::SendFrame)
+WIRE_BYTES_PER_POINT = 7
+WIRE_TRAILER_BYTES = 5
+
+class SimulatedDevice:
+    '''
+    Playback state of one simulated dac
+    '''
+    def __init__(self, usb_bytes_per_sec):
+        self.usb_bytes_per_sec = usb_bytes_per_sec
+        # When the waiting slot of the double buffer is free again
+        self.buffer_free_at = 0.0
+        # When the frame that was written last is done playing (once)
+        self.play_end = 0.0
+        # Duration of the last frame and whether it repeats
+        self.frame_time = 0.0
+        self.looping = False
+        self.shutter = False
+        # Unplugged devices come back at reconnect_at, but only once reopened
+        self.connected = True
+        self.closed = False
+        self.reconnect_at = 0.0
+        # What was written: dicts of points, pps, flags, written_at, start
+        self.frames = []
+        # Counters
+        self.frames_written = 0
+        self.points_written = 0
+        self.status_polls = 0
+        self.busy_polls = 0
+        self.frame_ready_errors = 0
+        self.idle_time = 0.0
+        self.blocked_time = 0.0
+
+class SimulatedHeliosLib:
+    '''
+    Stand-in for libHeliosDacAPI with num_devices simulated dacs.
+    usb_bytes_per_sec may be one value or one per device. status_time and
+    write_overhead are the fixed cost of a GetStatus and of a WriteFrame.
+    With record=False only counters are kept, not the frames. With
+    block_writes a WriteFrame before the buffer is free waits for it instead
+    of returning DEVICE_FRAME_READY.
+    '''
+    def __init__(self, num_devices=1, usb_bytes_per_sec=1e6, status_time=0.0, write_overhead=0.0, record=True,
+                 block_writes=False):
+        if(not hasattr(usb_bytes_per_sec, '__len__')):
+            usb_bytes_per_sec = [usb_bytes_per_sec]*num_devices
+        self.num_devices = num_devices
+        self.usb_bytes_per_sec = list(usb_bytes_per_sec)
+        self.status_time = status_time
+        self.write_overhead = write_overhead
+        self.record = record
+        self.block_writes = block_writes
+        self.lock = threading.Lock()
+        self.devices = [SimulatedDevice(rate) for rate in self.usb_bytes_per_sec]
+        self.opened = False
+        # Injected return codes per function name
+        self.injected = {}
+        self.opens = 0
+
+    def OpenDevices(self):
+        with self.lock:
+            now = time.perf_counter()
+            if(not self.opened):
+                for device in self.devices:
+                    if(not device.connected and now >= device.reconnect_at):
+                        device.connected = True
+                    # A reopened device starts with nothing playing
+                    if(device.connected):
+                        device.closed = False
+                        device.buffer_free_at = device.play_end = now
+                        device.looping = False
+                self.opened = True
+                self.opens += 1
+            return sum(device.connected for device in self.devices)
+
+    def CloseDevices(self):
+        with self.lock:
+            if(not self.opened):
+                return HELIOS_ERROR_NOT_INITIALIZED
+            self.opened = False
+            return HELIOS_SUCCESS
+
+    def disconnect(self, dac_idx=0, down_for=0.0):
+        '''
+        Unplugs a dac, it can be reopened again after down_for seconds
+        '''
+        with self.lock:
+            device = self.devices[dac_idx]
+            device.connected = False
+            device.closed = True
+            device.reconnect_at = time.perf_counter() + down_for
+
+    def fail_next(self, call, code, count=1):
+        '''
+        Makes the next count calls of call (e.g. 'WriteFrame') return code
+        '''
+        with self.lock:
+            self.injected.setdefault(call, []).extend([code]*count)
+
+    def check_device(self, dac_idx, call=None):
+        '''
+        0 if dac_idx can be used, else the error code the library returns
+        '''
+        if(not self.opened):
+            return HELIOS_ERROR_NOT_INITIALIZED
+        if(dac_idx < 0 or dac_idx >= len(self.devices)):
+            return HELIOS_ERROR_INVALID_DEVNUM
+        if(self.devices[dac_idx].closed):
+            return HELIOS_ERROR_DEVICE_CLOSED
+        with self.lock:
+            injected = self.injected.get(call)
+            if(injected):
+                return injected.pop(0)
+        return 0
+
+    def GetStatus(self, dac_idx):
+        error = self.check_device(dac_idx, 'GetStatus')
+        if(error):
+            return error
+        if(self.status_time):
+            time.sleep(self.status_time)
+        with self.lock:
+            device = self.devices[dac_idx]
+            device.status_polls += 1
+            if(time.perf_counter() < device.buffer_free_at):
+                device.busy_polls += 1
+                return 0
+            return 1
+
+    def WriteFrame(self, dac_idx, pps, flags, points, num_points):
+        error = self.check_device(dac_idx, 'WriteFrame')
+        if(error):
+            return error
+        if(points is None):
+            return HELIOS_ERROR_NULL_POINTS
+        if(num_points > laser_lib.HELIOS_MAX_POINTS):
+            return HELIOS_ERROR_TOO_MANY_POINTS
+        if(pps > HELIOS_MAX_RATE):
+            return HELIOS_ERROR_PPS_TOO_HIGH
+        if(pps < HELIOS_MIN_RATE):
+            return HELIOS_ERROR_PPS_TOO_LOW
+        device = self.devices[dac_idx]
+        # Copy the points now, the caller may reuse its buffer after the call
+        frame_points = None
+        if(self.record):
+            frame_points = np.frombuffer(ctypes.string_at(points, num_points*laser_lib.helios_point_dtype.itemsize),
+                                         dtype=laser_lib.helios_point_dtype).copy()
+        # The transfer is not accepted until the waiting slot is free
+        wait_s = device.buffer_free_at - time.perf_counter()
+        if(wait_s > 0):
+            if(not self.block_writes):
+                with self.lock:
+                    device.frame_ready_errors += 1
+                return HELIOS_ERROR_DEVICE_FRAME_READY
+            time.sleep(wait_s)
+            device.blocked_time += wait_s
+        # Sleeping releases the GIL like the real ctypes call does
+        time.sleep(self.write_overhead + (num_points*WIRE_BYTES_PER_POINT + WIRE_TRAILER_BYTES)/device.usb_bytes_per_sec)
+        with self.lock:
+            now = time.perf_counter()
+            if(flags & HELIOS_FLAGS_START_IMMEDIATELY):
+                start = now
+            elif(device.looping and device.frame_time > 0 and now > device.play_end):
+                # A looping frame finishes its current repetition first
+                repeats = math.ceil((now - device.play_end)/device.frame_time)
+                start = device.play_end + repeats*device.frame_time
+            else:
+                start = max(now, device.play_end)
+                # Output stopped after a single mode frame ran out
+                if(device.frames_written and not device.looping):
+                    device.idle_time += max(0.0, now - device.play_end)
+            device.buffer_free_at = start
+            device.frame_time = num_points/pps
+            device.play_end = start + device.frame_time
+            device.looping = not (flags & HELIOS_FLAGS_SINGLE_MODE)
+            device.frames_written += 1
+            device.points_written += num_points
+            if(self.record):
+                device.frames.append({'points': frame_points, 'pps': pps, 'flags': flags,
+                                      'written_at': now, 'start': start})
+        return HELIOS_SUCCESS
+
+    def SetShutter(self, dac_idx, shutter_value=True):
+        error = self.check_device(dac_idx, 'SetShutter')
+        if(error):
+            return error
+        self.devices[dac_idx].shutter = bool(shutter_value)
+        return HELIOS_SUCCESS
+
+    def Stop(self, dac_idx):
+        error = self.check_device(dac_idx, 'Stop')
+        if(error):
+            return error
+        with self.lock:
+            device = self.devices[dac_idx]
+            now = time.perf_counter()
+            device.buffer_free_at = now
+            device.play_end = now
+            device.looping = False
+        return HELIOS_SUCCESS
+
+    def points(self, dac_idx=0):
+        '''
+        Every recorded point written to a dac, in order, as one helios_point_dtype array
+        '''
+        frames = self.devices[dac_idx].frames
+        if(not frames):
+            return np.empty(0, dtype=laser_lib.helios_point_dtype)
+        return np.concatenate([frame['points'] for frame in frames])
+
+    def clear(self):
+        '''
+        Drops the recorded frames
+        '''
+        with self.lock:
+            for device in self.devices:
+                device.frames = []
+
+    def stats(self, dac_idx=0):
+        with self.lock:
+            device = self.devices[dac_idx]
+            return {'frames': device.frames_written,
+                    'points': device.points_written,
+                    'status_polls': device.status_polls,
+                    'busy_polls': device.busy_polls,
+                    'frame_ready_errors': device.frame_ready_errors,
+                    'idle_time': device.idle_time,
+                    'blocked_time': device.blocked_time,
+                    'play_end': device.play_end,
+                    'shutter': device.shutter,
+                    'connected': device.connected,
+                    'opens': self.opens}
+
+if __name__ == "__main__":
+    # Checks laser_lib's streaming against the simulated dac: a producer that
+    # keeps ahead of playback (even with the ring mostly empty) causes no
+    # underruns, one slower than playback underruns on every frame
+    frame_points = 600
+    dac_rate = 30000
+    frame_time = frame_points/dac_rate
+    t = np.linspace(0, 2*np.pi, frame_points)
+    points, num_points = laser_lib.pack_frame(np.column_stack([np.cos(t), np.sin(t)])*1000 + 2000,
+                                              np.ones((frame_points, 3)))
+    for name, put_interval in [('ahead', 0.0), ('keeping up', 0.75*frame_time), ('falling behind', 1.5*frame_time)]:
+        lib = SimulatedHeliosLib()
+        queue = laser_lib.DacQueue(dac=laser_lib.Dac(lib=lib))
+        queue.dac_rate = dac_rate
+        stream = queue.start_streaming(capacity=4)
+        num_frames = 20
+        for _ in range(num_frames):
+            queue.write_frames(points, num_points, do_not_loop=True)
+            time.sleep(put_interval)
+        queue.stop_streaming()
+        underruns = stream.stats()['underruns']
+        idle_time = lib.stats()['idle_time']
+        print(f'{name:15s}: {underruns} underruns, dac idle {idle_time*1e3:.1f}ms')
+        if(put_interval < frame_time):
+            assert underruns == 0, underruns
+        else:
+            assert underruns >= num_frames - 2 and idle_time > 0, (underruns, idle_time)
+    print('Underrun counting ok')
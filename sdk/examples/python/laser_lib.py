@@ -1,7 +1,14 @@
 import ctypes
+import os
 import numpy as np
 import math
 import time
+import threading
+import collections
+import asyncio
+import functools
+import concurrent.futures
+import bisect
 
 #Define point structure
 class HeliosPoint(ctypes.Structure):
@@ -12,25 +19,238 @@ class HeliosPoint(ctypes.Structure):
                 ('g', ctypes.c_uint8),
                 ('b', ctypes.c_uint8),
                 ('i', ctypes.c_uint8)]
+
+# Numpy mirror of HeliosPoint so whole frames can be packed without per-point objects
+helios_point_dtype = np.dtype([('x', np.uint16),
+                               ('y', np.uint16),
+                               ('r', np.uint8),
+                               ('g', np.uint8),
+                               ('b', np.uint8),
+                               ('i', np.uint8)])
+assert helios_point_dtype.itemsize == ctypes.sizeof(HeliosPoint)
+
+# Largest frame the DAC accepts (HELIOS_MAX_POINTS in HeliosDac.h)
+HELIOS_MAX_POINTS = 0x1000
+HELIOS_MAX_RATE = 0xFFFF
+HELIOS_MIN_RATE = 7
+
+# Return codes (HeliosDac.h)
+HELIOS_SUCCESS = 1
+HELIOS_ERROR_NOT_INITIALIZED = -1
+HELIOS_ERROR_INVALID_DEVNUM = -2
+HELIOS_ERROR_NULL_POINTS = -3
+HELIOS_ERROR_TOO_MANY_POINTS = -4
+HELIOS_ERROR_PPS_TOO_HIGH = -5
+HELIOS_ERROR_PPS_TOO_LOW = -6
+HELIOS_ERROR_DEVICE_CLOSED = -1000
+HELIOS_ERROR_DEVICE_FRAME_READY = -1001
+HELIOS_ERROR_DEVICE_SEND_CONTROL = -1002
+HELIOS_ERROR_DEVICE_RESULT = -1003
+HELIOS_ERROR_DEVICE_NULL_BUFFER = -1004
+HELIOS_ERROR_DEVICE_SIGNAL_TOO_LONG = -1005
+# libusb errors are returned as HELIOS_ERROR_LIBUSB_BASE + the libusb code
+HELIOS_ERROR_LIBUSB_BASE = -5000
+
+helios_error_names = {HELIOS_ERROR_NOT_INITIALIZED: 'NOT_INITIALIZED',
+                      HELIOS_ERROR_INVALID_DEVNUM: 'INVALID_DEVNUM',
+                      HELIOS_ERROR_NULL_POINTS: 'NULL_POINTS',
+                      HELIOS_ERROR_TOO_MANY_POINTS: 'TOO_MANY_POINTS',
+                      HELIOS_ERROR_PPS_TOO_HIGH: 'PPS_TOO_HIGH',
+                      HELIOS_ERROR_PPS_TOO_LOW: 'PPS_TOO_LOW',
+                      HELIOS_ERROR_DEVICE_CLOSED: 'DEVICE_CLOSED',
+                      HELIOS_ERROR_DEVICE_FRAME_READY: 'DEVICE_FRAME_READY',
+                      HELIOS_ERROR_DEVICE_SEND_CONTROL: 'DEVICE_SEND_CONTROL',
+                      HELIOS_ERROR_DEVICE_RESULT: 'DEVICE_RESULT',
+                      HELIOS_ERROR_DEVICE_NULL_BUFFER: 'DEVICE_NULL_BUFFER',
+                      HELIOS_ERROR_DEVICE_SIGNAL_TOO_LONG: 'DEVICE_SIGNAL_TOO_LONG'}
+
+class HeliosError(RuntimeError):
+    '''
+    A Helios library call failed. code is the return code (None for timeouts).
+    '''
+    def __init__(self, code, call, dac_idx=None, message=None):
+        self.code = code
+        self.call = call
+        self.dac_idx = dac_idx
+        if(message is None):
+            message = f'{call} on dac {dac_idx} failed with {helios_error_name(code)} ({code})'
+        super().__init__(message)
+
+class HeliosArgumentError(HeliosError, ValueError):
+    '''
+    The call was rejected for its arguments, retrying will not help
+    '''
+
+class HeliosDeviceError(HeliosError):
+    '''
+    The device or the USB link failed, reopening the device may help
+    '''
+
+class HeliosTimeoutError(HeliosError, TimeoutError):
+    '''
+    The device did not become ready in time
+    '''
+
+def helios_error_name(code):
+    if(code is not None and code <= HELIOS_ERROR_LIBUSB_BASE):
+        return f'LIBUSB_ERROR {code - HELIOS_ERROR_LIBUSB_BASE}'
+    return helios_error_names.get(code, 'UNKNOWN_ERROR')
+
+def helios_error(code, call, dac_idx=None):
+    '''
+    The HeliosError subclass instance for a (negative) return code
+    '''
+    if(HELIOS_ERROR_PPS_TOO_LOW <= code <= HELIOS_ERROR_INVALID_DEVNUM):
+        return HeliosArgumentError(code, call, dac_idx)
+    return HeliosDeviceError(code, call, dac_idx)
+
+# Loaded Helios libraries by absolute path, each is loaded once per process
+_loaded_libs = {}
+_loaded_libs_lock = threading.Lock()
+
+def declare_prototypes(lib):
+    '''
+    Sets argtypes/restype of the HeliosDacAPI functions, so ctypes converts 
+    arguments directly instead of guessing, and rejects wrong ones.
+    WriteFrame then takes a HeliosPoint array as is, no ctypes.pointer needed.
+    '''
+    prototypes = {'OpenDevices': [],
+                  'CloseDevices': [],
+                  'GetStatus': [ctypes.c_uint],
+                  'WriteFrame': [ctypes.c_uint, ctypes.c_int, ctypes.c_uint8, 
+                                 ctypes.POINTER(HeliosPoint), ctypes.c_int],
+                  'SetShutter': [ctypes.c_uint, ctypes.c_bool],
+                  'Stop': [ctypes.c_uint]}
+    for name, argtypes in prototypes.items():
+        func = getattr(lib, name)
+        func.argtypes = argtypes
+        func.restype = ctypes.c_int
+    return lib
+
+def hot_path_functions(lib):
+    '''
+    WriteFrame and GetStatus for the per-frame calls, bound once. 
+    For a ctypes library these are separate untyped function pointers: checking 
+    argtypes costs more than the call itself (see ffi_benchmark.py), and the 
+    queue always passes ints and a HeliosPoint array, which ctypes hands 
+    over as a pointer without ctypes.pointer.
+    '''
+    if(not isinstance(lib, ctypes.CDLL)):
+        return lib.WriteFrame, lib.GetStatus
+    funcs = []
+    for name in ('WriteFrame', 'GetStatus'):
+        func = lib._FuncPtr((name, lib))
+        func.restype = ctypes.c_int
+        funcs.append(func)
+    return funcs
+
+def load_library(lib_path="./libHeliosDacAPI.so"):
+    '''
+    Loads libHeliosDacAPI with declared prototypes, or returns the already loaded one
+    '''
+    lib_path = os.path.abspath(lib_path)
+    with _loaded_libs_lock:
+        if(lib_path not in _loaded_libs):
+            _loaded_libs[lib_path] = declare_prototypes(ctypes.CDLL(lib_path))
+        return _loaded_libs[lib_path]
+
+def load_backend(backend=None, lib_path="./libHeliosDacAPI.so"):
+    '''
+    Returns the Helios library for a backend: 'usb' (libHeliosDacAPI) or 
+    'sim' (helios_sim.SimulatedHeliosLib). Defaults to $HELIOS_BACKEND, else 'usb'.
+    '''
+    if(backend is None):
+        backend = os.environ.get('HELIOS_BACKEND', 'usb')
+    if(backend == 'usb'):
+        return load_library(lib_path)
+    if(backend == 'sim'):
+        import helios_sim
+        return helios_sim.SimulatedHeliosLib()
+    raise ValueError(f'Unknown backend {backend}, use usb or sim')
+
 class Dac:
-    def __init__(self):
-        #Load and initialize library
-        self.HeliosLib = ctypes.cdll.LoadLibrary("./libHeliosDacAPI.so")
+    def __init__(self, lib=None, backend=None):
+        #Load and initialize library (or use the given library object, e.g. a fake for testing)
+        if(lib is None):
+            lib = load_backend(backend)
+        self.HeliosLib = lib
+        # Bound once, these are called for every frame
+        self.write_frame, self.get_status = hot_path_functions(lib)
         self.num_devices = self.HeliosLib.OpenDevices()
         print("Found ", self.num_devices, "Helios DACs")
         # Define limits
         self.xy_max = int(2**12-1)
+        # Counts reopens, so threads that saw the same failure reopen only once
+        self.generation = 0
+        self.lock = threading.Lock()
         # Open the shutter
-        self.HeliosLib.SetShutter(False) 
+        self.set_shutter(True)
+
+    def set_shutter(self, shutter_open):
+        '''
+        Opens (True) or closes (False) the shutter of every dac
+        '''
+        for dac_idx in range(self.num_devices):
+            self.HeliosLib.SetShutter(dac_idx, shutter_open)
+
+    def reopen(self, timeout=5.0, generation=None):
+        '''
+        Closes and reopens the devices, e.g. after one was unplugged and plugged back in.
+        Retries for up to timeout seconds until num_devices are found again, 
+        else raises HeliosDeviceError. Skipped if generation is given and another 
+        thread already reopened since. With several dacs the library numbers them 
+        in the order it finds them, which may differ after a reopen.
+        '''
+        with self.lock:
+            if(generation is not None and generation != self.generation):
+                return
+            deadline = time.perf_counter() + timeout
+            backoff = 0.01
+            while(True):
+                # CloseDevices is needed before OpenDevices rescans
+                self.HeliosLib.CloseDevices()
+                num_devices = self.HeliosLib.OpenDevices()
+                if(num_devices >= self.num_devices):
+                    break
+                if(time.perf_counter() + backoff > deadline):
+                    raise HeliosDeviceError(HELIOS_ERROR_DEVICE_CLOSED, 'OpenDevices', 
+                                            message=f'Only {max(num_devices, 0)} of {self.num_devices} dacs came back')
+                time.sleep(backoff)
+                backoff = min(2*backoff, 0.5)
+            self.generation += 1
+            self.set_shutter(True)
 
 class DacQueue:
     '''
     A queue for patterns sent to the dac. 
     Performs smart stitching between patterns.
+    With several dac_indices every frame is packed once and written to all 
+    of those dacs in parallel, one writer thread per dac. Each dac is polled 
+    on its own. A dac may have max_device_lag writes outstanding before 
+    write_frames waits for it, so the slowest dac sets the pace. With 
+    drop_lagging write_frames keeps pace with the fastest dac instead and a dac 
+    max_device_lag writes behind it misses frames (counted in device_drops). 
+    Only use that when every frame stands on its own (e.g. repeated animation 
+    frames): a pattern split over several single shot frames has a hole on the 
+    lagging dac, which jumps from the end of one frame to the start of a later 
+    one with the laser on.
+    With cache_bytes > 0, patterns submitted with a cache_key are kept packed in 
+    an LRU cache of up to that many bytes, so resubmitting a key with the same 
+    settings copies the packed points instead of transforming them again. The key 
+    names the content, the caller gives a new one whenever the arrays change.
     '''
-    def __init__(self):
+    def __init__(self, dac=None, dac_indices=None, max_device_lag=2, cache_bytes=0, 
+                 status_timeout=1.0, write_retries=2, reopen_timeout=5.0, drop_lagging=False):
         # Dac object for this queue
-        self.dac = Dac()
+        self.dac = Dac() if dac is None else dac
+        # Which of the dacs to write to
+        if(dac_indices is None):
+            dac_indices = [0]
+        elif(any(dac_idx < 0 or dac_idx >= self.dac.num_devices for dac_idx in dac_indices)):
+            raise ValueError(f'dac_indices {dac_indices} out of range for {self.dac.num_devices} dacs')
+        self.dac_indices = list(dac_indices)
+        self.max_device_lag = max_device_lag
+        self.drop_lagging = drop_lagging
         # The last position of the last pattern (x,y)
         self.last_pos = (0,0)
         # Sample rate of the DAC
@@ -40,107 +260,1177 @@ class DacQueue:
         # Color shift constants (this should change w/ dac_rate)
         #self.color_shifts = [11, 10, 9]
         self.color_shifts = [5, 5, 4]
+        # Per channel (R, G, B) modulator latency in microseconds. When set it replaces 
+        # color_shifts with fractional shifts for the current dac_rate, e.g. [167, 167, 133]
+        self.color_latency_us = None
+        # The last colors of the stream, so color shifts carry across submits
+        self.color_history = np.zeros((0, 3))
+        # Galvo limits in unit space per second (and per second squared). When both
+        # are set, transitions are velocity/acceleration limited moves (see blank_moves)
+        # instead of angular_density linspaces
+        self.max_velocity = None
+        self.max_accel = None
+        self.move_profile = 'trapezoid'
+        # Scale applied to the pattern so the amps do not clip
+        self.max_scale = 0.75
+        # Turns unit space patterns into dac points without temporaries
+        self.transform = FusedTransform()
+        # Packed patterns by cache_key and settings, None unless cache_bytes > 0
+        self.pattern_cache = PatternCache(max_bytes=cache_bytes) if cache_bytes > 0 else None
+        # Background sender, only set while streaming
+        self.stream = None
+        # Per-stage timers and counters, None when disabled (see enable_metrics)
+        self.metrics = None
+        # Error recovery (see send_frame_to)
+        self.status_timeout = status_timeout
+        self.write_retries = write_retries
+        self.reopen_timeout = reopen_timeout
+        # Continuous timeline, only set while scheduling
+        self.scheduler = None
+        # Decide when to ask each dac for its status
+        self.pollers = {dac_idx: StatusPoller() for dac_idx in self.dac_indices}
+        # Per dac writer threads and their outstanding writes (only used for several dacs)
+        self.device_executors = {}
+        self.device_writes = {dac_idx: collections.deque() for dac_idx in self.dac_indices}
+        # Frames each dac missed for being too far behind (drop_lagging)
+        self.device_drops = dict.fromkeys(self.dac_indices, 0)
         
     
-    def submit(self, pat_pos, pat_col, angular_density=100, debug=False, loop=False):
+    def submit(self, pat_pos, pat_col, angular_density=100, debug=False, loop=False, cache_key=None):
         '''
         Submits a new pattern to the dac, transitioning smoothly from the last one.
         Angular density describes how many points per radian should be used to transition
+        Returns the number of frames written to the dac (see prep_submit).
+        cache_key (any hashable) names the pattern for the pattern cache, see DacQueue.
+        With the scheduler running the pattern joins its timeline instead (see StreamScheduler).
         '''
-        # Make the transition
-        dist = np.sqrt(np.sum(np.power(self.last_pos-pat_pos[0,:], 2)))
-        num_gap_points = int(dist*angular_density)
+        if(self.scheduler is not None):
+            if(not debug):
+                return self.scheduler.submit(pat_pos, pat_col, angular_density=angular_density, loop=loop, 
+                                             cache_key=cache_key)
+            # Debug frames play at another rate, so they cannot share frames with the timeline
+            self.scheduler.flush()
+        frames = self.prep_submit(pat_pos, pat_col, angular_density=angular_density, debug=debug, loop=loop, 
+                                  cache_key=cache_key)
+        for points, num_points, do_not_loop in frames:
+            self.write_frames(points, num_points, do_not_loop=do_not_loop, debug=debug)
+        return len(frames)
+
+    def prep_submit(self, pat_pos, pat_col, angular_density=100, debug=False, loop=False, cache_key=None):
+        '''
+        Builds the frames for submit without sending them and moves last_pos on.
+        The transition gap is sent in the same frame as the start of the pattern and 
+        patterns longer than HELIOS_MAX_POINTS are split into back to back frames.
+        When looping, only the final frame repeats (the whole pattern if it fits).
+        Returns a list of (points, num_points, do_not_loop).
+        '''
+        buf = self.prep_stream(pat_pos, pat_col, angular_density=angular_density, debug=debug, loop=loop, 
+                               cache_key=cache_key)
+        num_points = len(buf)
+        if(loop):
+            # The repeated frame must hold nothing but (the end of) the pattern
+            num_loop_points = min(len(pat_pos), HELIOS_MAX_POINTS)
+            frames = split_frames(buf[:num_points-num_loop_points]) + split_frames(buf[num_points-num_loop_points:])
+        else:
+            frames = split_frames(buf)
+
+        # Everything but the last frame plays once
+        return [(points, num_points, not (loop and idx == len(frames)-1)) 
+                for idx, (points, num_points) in enumerate(frames)]
 
-        gap_pos = np.linspace(self.last_pos, pat_pos[0,:], num_gap_points, dtype=float)
+    def prep_stream(self, pat_pos, pat_col, angular_density=100, debug=False, loop=False, cache_key=None):
+        '''
+        Packs the transition from last_pos and the pattern into one buffer 
+        of points (helios_point_dtype) and moves last_pos on.
+        Color shifts delay the colors of the whole stream: the start of the gap 
+        gets the end of the previous submit's colors (see color_history). 
+        A looping pattern is periodic, so its colors wrap around instead.
+        '''
+        metrics = self.metrics
+        if(metrics is not None):
+            geometry_start = time.perf_counter()
+        # Make the transition
+        if(self.max_velocity and self.max_accel):
+            gap_pos = blank_move(self.last_pos, pat_pos[0,:], self.dac_rate, self.max_velocity, 
+                                 self.max_accel, profile=self.move_profile)
+        else:
+            dist = np.sqrt(np.sum(np.power(self.last_pos-pat_pos[0,:], 2)))
+            gap_pos = np.linspace(self.last_pos, pat_pos[0,:], int(dist*angular_density), dtype=float)
+        num_gap_points = len(gap_pos)
         gap_col = np.zeros((num_gap_points, 3), dtype=float)
         if(debug):
             gap_col = np.ones_like(gap_col)/4
+        if(metrics is not None):
+            metrics.add_time('geometry', time.perf_counter() - geometry_start)
+            metrics.count('gap_points', num_gap_points)
 
+        # The transition and the pattern are packed straight into one stream of points
+        num_pat_points = len(pat_pos)
+        num_points = num_gap_points + num_pat_points
+        buf = np.empty(num_points, dtype=helios_point_dtype)
         # Prep the transition pattern
-        gap_points, num_gap_points = self.prep_pattern(gap_pos, gap_col, gap=True)
-        
+        self.prep_pattern(gap_pos, gap_col, gap=True, out=buf[:num_gap_points], stream=True)
+        self.push_color_history(gap_col, gap=True)
         # Prep the new pattern
-        pat_points, num_pat_points = self.prep_pattern(pat_pos, pat_col)
-        
-        # Send the transition pattern to the dac
-        self.write_frames(gap_points, num_gap_points, do_not_loop=not loop, debug=debug)
-        # Send the new pattern to the dac
-        self.write_frames(pat_points, num_pat_points, do_not_loop=not loop, debug=debug)
+        self.prep_pattern(pat_pos, pat_col, out=buf[num_gap_points:], stream=not loop, cache_key=cache_key)
+        self.push_color_history(pat_col)
         # Set the last_position
         self.last_pos = pat_pos[-1, :].copy()
+        return buf
         
-    def prep_pattern(self, arr_pos, arr_col, gap=False):
+    def prep_pattern(self, arr_pos, arr_col, gap=False, out=None, stream=False, cache_key=None):
         '''
         1) Scales and color corrects 
         2) Converts from unit space to DAC coordinates
         3) Produces a DAC compatible frame and displays it
+        Same result as position_corection and color_correction followed by pack_frame,
+        but done by the fused transform. The points are written into out 
+        (a helios_point_dtype array) if given. 
+        With stream the color shifts are a delay line fed from color_history 
+        instead of np.roll's wraparound, and apply to gaps too (uncorrected). 
+        Negative shifts cannot be delayed and fall back to the wraparound.
+        Patterns (not gaps) with a cache_key are looked up in and added to the 
+        pattern cache, a hit is copied into out instead of transformed.
         '''
-        # Force pass-by-value
-        arr_pos = arr_pos.copy()
-        arr_col = arr_col.copy()
-        # Scale the pattern 
-        arr_pos = position_corection(arr_pos)
-        # Format the position array (-1.0-1.0) -> int(0-4095)
-        arr_pos = (((arr_pos+1)/2.0)*self.dac.xy_max).astype(np.int32)
-
-        # Perform color correction if not gap points
-        if(not gap):
-            arr_col = color_correction(arr_col, color_shifts=self.color_shifts)
-        # Format the color array (0-1.0) -> int(0-255)
-        arr_col = (arr_col*255).astype(np.int32)
-        # Fill a heliospoint arr with these values
         num_points = len(arr_pos)
-
-        frameType = HeliosPoint * num_points
-        points = frameType()
-        # Fill the frame
-        for idx in range(num_points):
-            points[idx] =     HeliosPoint(int(arr_pos[idx, 0]), 
-                                         int(arr_pos[idx, 1]), 
-                                         int(arr_col[idx, 0]), 
-                                         int(arr_col[idx, 1]),
-                                         int(arr_col[idx, 2]),
-                                         int(255))
-        
+        if(out is None):
+            out = np.empty(num_points, dtype=helios_point_dtype)
+        color_shifts = self.active_color_shifts()
+        history = None
+        if(stream and min(color_shifts, default=0) >= 0):
+            history = self.stream_color_history(color_shifts)
+        metrics = self.metrics
+        key = None
+        if(self.pattern_cache is not None and cache_key is not None and not gap):
+            if(metrics is not None):
+                cache_start = time.perf_counter()
+            key = self.pattern_key(cache_key, history)
+            cached = self.pattern_cache.get(key)
+            if(cached is not None):
+                np.copyto(out.view(np.uint8), cached)
+            if(metrics is not None):
+                metrics.add_time('cache', time.perf_counter() - cache_start)
+            if(cached is not None):
+                return (HeliosPoint * num_points).from_buffer(out), num_points
+        if(gap and history is None):
+            color_shifts = None
+        if(metrics is not None):
+            transform_start = time.perf_counter()
+        self.transform.apply(arr_pos, arr_col, out, self.dac.xy_max, self.max_scale, color_shifts, 
+                             history=history, correct=not gap)
+        if(key is not None):
+            self.pattern_cache.put(key, out.view(np.uint8).copy())
+        points = (HeliosPoint * num_points).from_buffer(out)
+        if(metrics is not None):
+            metrics.add_time('transform', time.perf_counter() - transform_start)
         return points, num_points
+
+    def pattern_key(self, cache_key, history=None):
+        '''
+        Cache key of a pattern: the caller's cache_key plus every setting prep_pattern 
+        depends on. The color history is only a few samples, so its bytes are cheap to key on.
+        '''
+        return (cache_key, tuple(self.active_color_shifts()), self.dac.xy_max, self.max_scale, 
+                None if history is None else history.tobytes())
+
+    def active_color_shifts(self):
+        '''
+        Color shifts in samples for the current settings: color_shifts, or derived 
+        from color_latency_us and dac_rate (fractional, cached per rate and latency)
+        '''
+        if(self.color_latency_us is None):
+            return self.color_shifts
+        return color_shifts_for_rate(self.dac_rate, tuple(self.color_latency_us))
+
+    def stream_color_history(self, color_shifts):
+        '''
+        The last colors sent (corrected, before shifting), as many as the 
+        color_shifts reach back. Black before anything was sent.
+        '''
+        hist_len = int(np.ceil(max(color_shifts, default=0))) + 1
+        missing = hist_len - len(self.color_history)
+        if(missing > 0):
+            return np.concatenate([np.zeros((missing, 3)), self.color_history])
+        return self.color_history[len(self.color_history)-hist_len:]
+
+    def push_color_history(self, arr_col, gap=False):
+        '''
+        Appends the colors of what was just packed to color_history
+        '''
+        hist_len = int(np.ceil(max(self.active_color_shifts(), default=0))) + 1
+        tail = np.asarray(arr_col[len(arr_col)-min(hist_len, len(arr_col)):], dtype=float)
+        if(not gap):
+            tail = correct_colors(tail)
+        self.color_history = np.concatenate([self.color_history, tail])[-hist_len:]
             
+    def enable_metrics(self, export_interval=None, export_fn=None):
+        '''
+        Starts timing the stages of submit and counting frames, see QueueMetrics.
+        Returns the QueueMetrics, whose snapshot() can be read at any time.
+        '''
+        self.metrics = QueueMetrics(export_interval=export_interval, export_fn=export_fn)
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def start_streaming(self, capacity=8, policy='block'):
+        '''
+        Hands frame writing to a background thread. From now on write_frames 
+        (and so submit) only enqueues packed frames and returns.
+        See FrameStream for the capacity and policy options.
+        '''
+        if(self.stream is None):
+            self.stream = FrameStream(self, capacity=capacity, policy=policy)
+            self.stream.start()
+        return self.stream
+
+    def start_scheduler(self, latency=0.02, margin=0.005):
+        '''
+        Switches submit to a continuous timeline: gaps and patterns are spliced 
+        together and written as frames of about latency seconds at dac_rate.
+        See StreamScheduler.
+        '''
+        if(self.scheduler is None):
+            self.scheduler = StreamScheduler(self, latency=latency, margin=margin).start()
+        return self.scheduler
+
+    def stop_scheduler(self):
+        '''
+        Writes out whatever the timeline still holds and goes back to one submit, one write
+        '''
+        if(self.scheduler is not None):
+            scheduler = self.scheduler
+            self.scheduler = None
+            scheduler.stop()
+
+    def stop_streaming(self, drain=True):
+        '''
+        Stops the background thread (after sending what is queued if drain) 
+        and goes back to writing frames on the calling thread.
+        '''
+        if(self.stream is not None):
+            self.stream.stop(drain=drain)
+            self.stream = None
+        self.flush()
+
     def write_frames(self, points, num_points, do_not_loop=False, start_immediately=False, debug=False):
         if(num_points < 1):
             return
-        # Write the values out 
-        status_attempts = 0
-        max_attempts = np.inf
-        # Make 512 attempts for DAC status to be ready. After that, just give up and try to write the frame anyway
-        while(status_attempts < max_attempts and self.dac.HeliosLib.GetStatus(0) != 1):
-            status_attempts += 1
-            
         # Create flags 
         flags = do_not_loop << 1 | start_immediately << 0
-        # Send to DAC
         frame_rate = self.debug_rate if debug else self.dac_rate
-        self.dac.HeliosLib.WriteFrame(0, frame_rate, flags, ctypes.pointer(points), num_points)
+        # Let the sender thread deliver it when streaming
+        if(self.stream is not None):
+            self.stream.put(points, num_points, frame_rate, flags)
+            return
+        self.send_frame(points, num_points, frame_rate, flags)
 
-def color_correction(arr_col, color_shifts=[]):
+    def send_frame(self, points, num_points, frame_rate, flags):
+        '''
+        Writes one frame to every dac of this queue. 
+        A single dac is written on the calling thread, several in parallel.
+        '''
+        if(len(self.dac_indices) == 1):
+            self.send_frame_to(self.dac_indices[0], points, num_points, frame_rate, flags)
+            return
+        self.collect_writes()
+        # Lagging means max_device_lag writes behind the fastest dac, not just busy
+        fastest = min(len(writes) for writes in self.device_writes.values())
+        for dac_idx in self.dac_indices:
+            writes = self.device_writes[dac_idx]
+            if(self.drop_lagging and len(writes) >= fastest + self.max_device_lag):
+                self.device_drops[dac_idx] += 1
+                continue
+            if(dac_idx not in self.device_executors):
+                self.device_executors[dac_idx] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'Dac{dac_idx}')
+            write = self.device_executors[dac_idx].submit(self.send_frame_to, dac_idx, 
+                                                          points, num_points, frame_rate, flags)
+            writes.append(write)
+        if(self.drop_lagging):
+            # Wait for the fastest dac to have room for the next frame
+            while(min(len(writes) for writes in self.device_writes.values()) > self.max_device_lag):
+                concurrent.futures.wait([writes[0] for writes in self.device_writes.values()],
+                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                self.collect_writes()
+            return
+        # Wait on dacs that fell too far behind
+        for dac_idx in self.dac_indices:
+            writes = self.device_writes[dac_idx]
+            while(writes and (writes[0].done() or len(writes) > self.max_device_lag)):
+                writes.popleft().result()
+
+    def collect_writes(self):
+        '''
+        Drops the finished parallel writes, raising their errors
+        '''
+        for writes in self.device_writes.values():
+            while(writes and writes[0].done()):
+                writes.popleft().result()
+
+    def send_frame_to(self, dac_idx, points, num_points, frame_rate, flags):
+        '''
+        Waits for one dac to be ready and writes one frame to it, on the calling thread.
+        A device error or a dac that is not ready status_timeout seconds after it 
+        should have been is retried up to write_retries times, reopening the dacs 
+        first (a DEVICE_FRAME_READY is just retried). Raises the last HeliosError, 
+        so a write takes at most about (write_retries+1)*status_timeout + 
+        write_retries*reopen_timeout seconds more than the wait for the buffer.
+        HeliosArgumentErrors are raised right away.
+        '''
+        for attempt in range(self.write_retries + 1):
+            generation = self.dac.generation
+            try:
+                self.write_frame_once(dac_idx, points, num_points, frame_rate, flags)
+                return
+            except (HeliosDeviceError, HeliosTimeoutError) as e:
+                if(self.metrics is not None):
+                    self.metrics.count('write_errors')
+                if(attempt == self.write_retries):
+                    raise
+                if(e.code == HELIOS_ERROR_DEVICE_FRAME_READY):
+                    continue
+                if(self.metrics is not None):
+                    self.metrics.count('reopens')
+                self.dac.reopen(timeout=self.reopen_timeout, generation=generation)
+                # Nothing is playing after a reopen
+                self.pollers[dac_idx].reset()
+
+    def write_frame_once(self, dac_idx, points, num_points, frame_rate, flags):
+        '''
+        One attempt of send_frame_to, raises HeliosError on failure
+        '''
+        poller = self.pollers[dac_idx]
+        metrics = self.metrics
+        if(metrics is not None):
+            polls = poller.polls
+            wait_start = time.perf_counter()
+        # Sleep until the buffer should be free, then poll for it
+        timeout = max(0.0, poller.ready_at - time.perf_counter()) + self.status_timeout
+        if(not poller.wait_ready(self.dac, dac_idx, timeout=timeout)):
+            raise HeliosTimeoutError(None, 'GetStatus', dac_idx, 
+                                     message=f'Dac {dac_idx} not ready after {timeout:.3f}s')
+        if(metrics is not None):
+            write_start = time.perf_counter()
+            metrics.add_time('status_wait', write_start - wait_start)
+            metrics.count('status_polls', poller.polls - polls)
+        # Send to DAC
+        result = self.dac.write_frame(dac_idx, frame_rate, flags, points, num_points)
+        if(result != HELIOS_SUCCESS):
+            raise helios_error(result, 'WriteFrame', dac_idx)
+        poller.frame_written(num_points, frame_rate, start_immediately=flags & 1)
+        if(metrics is not None):
+            metrics.add_time('usb_write', time.perf_counter() - write_start)
+            metrics.frame_written(dac_idx, num_points, frame_rate)
+
+    def flush(self):
+        '''
+        Waits for the outstanding parallel writes to finish
+        '''
+        for writes in self.device_writes.values():
+            while(writes):
+                writes.popleft().result()
+
+class AsyncDacQueue:
     '''
-    Corrects the nonlinearities in the color curve 
-    Color shifts correspond to [Red, Green, Blue]
+    asyncio front end for a DacQueue. 
+    Packing runs on one worker thread and the blocking GetStatus/WriteFrame 
+    calls on another, so the event loop never waits on the dac and the next 
+    pattern is packed while the current one waits for the buffer.
+    '''
+    def __init__(self, queue=None, max_pending=8):
+        # The wrapped queue, its settings (dac_rate, color_shifts...) still apply
+        self.queue = DacQueue() if queue is None else queue
+        # Single workers keep patterns in submission order
+        self.pack_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='DacPack')
+        self.send_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='DacSend')
+        self.max_pending = max_pending
+        # Created on first submit so they belong to the running loop
+        self.pending = None
+        self.worker = None
+
+    async def submit(self, pat_pos, pat_col, angular_density=100, debug=False, loop=False, cache_key=None):
+        '''
+        Queues a pattern (see DacQueue.submit) and returns a future that resolves 
+        to the number of frames written once the last of them is handed to the dac.
+        Waits without blocking the loop while max_pending patterns are queued.
+        '''
+        ev_loop = asyncio.get_running_loop()
+        if(self.worker is None):
+            self.pending = asyncio.Queue(maxsize=self.max_pending)
+            self.worker = ev_loop.create_task(self._run())
+        # Callers often reuse their arrays, take a snapshot before packing later
+        pat_pos = np.array(pat_pos, dtype=float)
+        pat_col = np.array(pat_col, dtype=float)
+        prep = functools.partial(self.queue.prep_submit, pat_pos, pat_col, 
+                                 angular_density=angular_density, debug=debug, loop=loop, cache_key=cache_key)
+        packed = ev_loop.run_in_executor(self.pack_executor, prep)
+        done = ev_loop.create_future()
+        await self.pending.put((packed, done, debug))
+        return done
+
+    async def join(self):
+        '''
+        Waits until every queued pattern has been written
+        '''
+        if(self.pending is not None):
+            await self.pending.join()
+
+    async def close(self):
+        '''
+        Writes what is queued, then stops the worker threads
+        '''
+        await self.join()
+        if(self.worker is not None):
+            self.worker.cancel()
+            self.worker = None
+        self.pack_executor.shutdown()
+        self.send_executor.shutdown()
+
+    async def _run(self):
+        ev_loop = asyncio.get_running_loop()
+        while(True):
+            packed, done, debug = await self.pending.get()
+            try:
+                frames = await packed
+                for points, num_points, do_not_loop in frames:
+                    write = functools.partial(self.queue.write_frames, points, num_points, 
+                                              do_not_loop=do_not_loop, debug=debug)
+                    await ev_loop.run_in_executor(self.send_executor, write)
+            except Exception as e:
+                if(not done.done()):
+                    done.set_exception(e)
+            else:
+                if(not done.done()):
+                    done.set_result(len(frames))
+            finally:
+                self.pending.task_done()
+
+class StreamScheduler:
+    '''
+    A continuous output timeline for a DacQueue. 
+    Each submit appends its transition and pattern to the pending points and 
+    full frames of frame_points() (latency seconds at dac_rate) are written 
+    as soon as they are complete, so the end of one pattern, the next gap and 
+    the start of the next pattern share transfers. A partial frame is only 
+    written early when the dac has less than margin seconds left to play,
+    by the next submit or by a watcher thread (start()) that wakes up margin
+    seconds before the dacs run out, so the tail of the last pattern is
+    never left waiting for another submit.
+    When the dacs run out is the later of the pollers' prediction and the end 
+    of what the scheduler wrote, played back to back from when it was written. 
+    While streaming the pollers only know the frames the sender has written, 
+    not those still in its ring.
+    An error writing from the watcher stops it and is raised by the next 
+    submit (or add, flush, stop), like FrameStream.
+    Frames are single shot, an idle dac blanks instead of repeating a fragment.
+    '''
+    def __init__(self, queue, latency=0.02, margin=0.005):
+        self.queue = queue
+        self.latency = latency
+        self.margin = margin
+        self.pending = np.empty(0, dtype=helios_point_dtype)
+        # Guards pending and the writes, submit and the watcher both write
+        self.cond = threading.Condition(threading.RLock())
+        self.thread = None
+        self.running = False
+        # Set if the watcher died
+        self.error = None
+        # When what was written plays out, going by the writes alone
+        self.written_end = 0.0
+        # Counters
+        self.frames = 0
+        self.points = 0
+        self.early_frames = 0
+
+    def frame_points(self):
+        return int(min(HELIOS_MAX_POINTS, max(1, self.latency*self.queue.dac_rate)))
+
+    def submit(self, pat_pos, pat_col, angular_density=100, loop=False, cache_key=None):
+        '''
+        Adds a pattern to the timeline, returns the number of frames written.
+        A looping pattern ends the timeline: everything before it is written 
+        out and its frame repeats until the next submit.
+        '''
+        with self.cond:
+            if(self.error is not None):
+                raise self.error
+        buf = self.queue.prep_stream(pat_pos, pat_col, angular_density=angular_density, loop=loop, 
+                                     cache_key=cache_key)
+        with self.cond:
+            if(not loop):
+                return self.add(buf)
+            num_loop_points = min(len(pat_pos), HELIOS_MAX_POINTS)
+            num_frames = self.add(buf[:len(buf)-num_loop_points], flush=True)
+            for points, num_points in split_frames(buf[len(buf)-num_loop_points:]):
+                self.queue.write_frames(points, num_points, do_not_loop=False)
+            return num_frames + 1
+
+    def add(self, buf, flush=False):
+        '''
+        Appends packed points and writes every complete frame (and the rest if flush)
+        '''
+        with self.cond:
+            if(self.error is not None):
+                raise self.error
+            self.pending = np.concatenate([self.pending, buf]) if len(self.pending) else buf
+            frame_points = self.frame_points()
+            num_frames = 0
+            while(len(self.pending) >= frame_points or (len(self.pending) and (flush or self.running_dry()))):
+                if(len(self.pending) < frame_points and not flush):
+                    self.early_frames += 1
+                chunk = self.pending[:frame_points]
+                self.pending = self.pending[frame_points:]
+                self.queue.write_frames((HeliosPoint * len(chunk)).from_buffer(chunk), len(chunk), do_not_loop=True)
+                self.written_end = max(time.perf_counter(), self.written_end) + len(chunk)/self.queue.dac_rate
+                self.frames += 1
+                self.points += len(chunk)
+                num_frames += 1
+            # The watcher sleeps until the dacs are about to run out of what was written
+            if(len(self.pending)):
+                self.cond.notify_all()
+            return num_frames
+
+    def flush(self):
+        return self.add(np.empty(0, dtype=helios_point_dtype), flush=True)
+
+    def start(self):
+        '''
+        Starts the watcher thread that writes the pending tail before the dacs run dry
+        '''
+        if(self.thread is None):
+            self.running = True
+            self.thread = threading.Thread(target=self._watch, name='StreamScheduler', daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops the watcher and writes out whatever is pending, 
+        or raises the error that stopped the watcher
+        '''
+        if(self.thread is not None):
+            with self.cond:
+                self.running = False
+                self.cond.notify_all()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def _watch(self):
+        with self.cond:
+            while(self.running):
+                if(not len(self.pending)):
+                    self.cond.wait()
+                    continue
+                wait_s = self.play_end() - time.perf_counter() - self.margin
+                if(wait_s > 0):
+                    # A submit in the meantime may write the tail itself
+                    self.cond.wait(wait_s)
+                    continue
+                try:
+                    self.add(np.empty(0, dtype=helios_point_dtype))
+                except Exception as e:
+                    self.error = e
+                    self.running = False
+                    return
+
+    def play_end(self):
+        '''
+        When the first dac is predicted to finish what it was given
+        '''
+        return max(self.written_end, min(poller.play_end for poller in self.queue.pollers.values()))
+
+    def running_dry(self):
+        '''
+        True if some dac is predicted to finish what it was given within margin seconds
+        '''
+        return self.play_end() - time.perf_counter() < self.margin
+
+    def stats(self):
+        '''
+        Snapshot of the counters
+        '''
+        return {'frames': self.frames,
+                'points': self.points,
+                'points_per_frame': self.points/max(self.frames, 1),
+                'early_frames': self.early_frames,
+                'pending_points': len(self.pending)}
+
+class StatusPoller:
+    '''
+    Waits for the dac buffer to be free without spinning on GetStatus.
+    The dac is double buffered, so a written frame frees the buffer once the 
+    frame playing before it finishes. From the point counts and rates of the 
+    frames written so far we predict that moment, sleep until lead_time before it 
+    and then poll with exponential backoff from min_backoff up to max_backoff.
+    '''
+    def __init__(self, lead_time=0.0005, min_backoff=0.00005, max_backoff=0.001):
+        self.lead_time = lead_time
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # Predicted times (time.perf_counter) the buffer frees and the output runs dry
+        self.ready_at = 0.0
+        self.play_end = 0.0
+        # Counters
+        self.frames = 0
+        self.polls = 0
+        self.sleep_time = 0.0
+        self.wait_time = 0.0
+        self.wasted_wait = 0.0
+
+    def wait_ready(self, dac, dac_idx, timeout=None):
+        '''
+        Blocks until GetStatus (dac.get_status) reports ready. Returns False if timeout (s) ran out first.
+        Raises HeliosError if GetStatus returns an error code.
+        '''
+        start = time.perf_counter()
+        sleep_for = self.ready_at - self.lead_time - start
+        if(sleep_for > 0):
+            time.sleep(sleep_for)
+            self.sleep_time += sleep_for
+        backoff = self.min_backoff
+        last_busy = None
+        ready = True
+        while(True):
+            self.polls += 1
+            status = dac.get_status(dac_idx)
+            if(status == 1):
+                break
+            if(status < 0):
+                self.wait_time += time.perf_counter() - start
+                raise helios_error(status, 'GetStatus', dac_idx)
+            last_busy = time.perf_counter()
+            if(timeout is not None and last_busy - start >= timeout):
+                ready = False
+                break
+            time.sleep(backoff)
+            self.sleep_time += backoff
+            backoff = min(2*backoff, self.max_backoff)
+        now = time.perf_counter()
+        self.wait_time += now - start
+        # The buffer freed somewhere after the last busy poll, so this bounds the time lost
+        if(ready and last_busy is not None):
+            self.wasted_wait += now - last_busy
+        return ready
+
+    def reset(self):
+        '''
+        Forgets the predicted playback, e.g. after the dac was reopened
+        '''
+        self.ready_at = 0.0
+        self.play_end = 0.0
+
+    def frame_written(self, num_points, frame_rate, start_immediately=False):
+        '''
+        Updates the prediction after a frame of num_points at frame_rate was written
+        '''
+        now = time.perf_counter()
+        start = now if start_immediately else max(now, self.play_end)
+        # The new frame waits in the buffer until the playing one is done
+        self.ready_at = start
+        self.play_end = start + num_points/frame_rate
+        self.frames += 1
+
+    def stats(self):
+        '''
+        Snapshot of the counters
+        '''
+        frames = max(self.frames, 1)
+        return {'frames': self.frames,
+                'polls': self.polls,
+                'polls_per_frame': self.polls/frames,
+                'sleep_time': self.sleep_time,
+                'wait_time': self.wait_time,
+                'wasted_wait': self.wasted_wait,
+                'wasted_wait_per_frame': self.wasted_wait/frames}
+
+class QueueMetrics:
+    '''
+    Low overhead instrumentation for a DacQueue (DacQueue.enable_metrics).
+    Accumulates the time spent per stage of a submit:
+        geometry    - making the gap to the pattern
+        cache       - hashing and looking up packed patterns
+        transform   - correction and packing (fused, see FusedTransform)
+        status_wait - waiting for the dac buffer (sleeping and GetStatus)
+        usb_write   - the WriteFrame call
+    counts frames, points, gap points, status polls, write errors and reopens, and keeps 
+    a histogram of the frame to frame jitter: how far the time between two 
+    writes to a dac is from the duration of the frame written first.
+    Every export_interval seconds export_fn is called with a snapshot() 
+    (on the thread that wrote the frame).
+    '''
+    STAGES = ('geometry', 'cache', 'transform', 'status_wait', 'usb_write')
+    # Jitter histogram bin edges in microseconds, the last bin is open ended
+    JITTER_EDGES_US = (0, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+    def __init__(self, export_interval=None, export_fn=None):
+        self.export_interval = export_interval
+        self.export_fn = export_fn
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stage_time = dict.fromkeys(self.STAGES, 0.0)
+            self.stage_max = dict.fromkeys(self.STAGES, 0.0)
+            self.stage_calls = dict.fromkeys(self.STAGES, 0)
+            self.counters = {'frames': 0, 'points': 0, 'gap_points': 0, 'status_polls': 0, 
+                             'write_errors': 0, 'reopens': 0}
+            self.jitter_counts = [0]*len(self.JITTER_EDGES_US)
+            # Time and duration of the last frame written to each dac
+            self.last_write = {}
+            self.started = time.perf_counter()
+            self.last_export = self.started
+
+    def add_time(self, stage, duration_s):
+        with self.lock:
+            self.stage_time[stage] += duration_s
+            self.stage_calls[stage] += 1
+            if(duration_s > self.stage_max[stage]):
+                self.stage_max[stage] = duration_s
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def frame_written(self, dac_idx, num_points, frame_rate):
+        '''
+        Records a successful WriteFrame
+        '''
+        now = time.perf_counter()
+        with self.lock:
+            self.counters['frames'] += 1
+            self.counters['points'] += num_points
+            last = self.last_write.get(dac_idx)
+            if(last is not None):
+                jitter_us = abs((now - last[0]) - last[1])*1e6
+                self.jitter_counts[bisect.bisect_right(self.JITTER_EDGES_US, jitter_us) - 1] += 1
+            self.last_write[dac_idx] = (now, num_points/frame_rate)
+            export = (self.export_fn is not None and self.export_interval is not None 
+                      and now - self.last_export >= self.export_interval)
+            if(export):
+                self.last_export = now
+        if(export):
+            self.export_fn(self.snapshot())
+
+    def snapshot(self):
+        '''
+        Copy of the timers, counters and jitter histogram
+        '''
+        with self.lock:
+            stages = {}
+            for stage in self.STAGES:
+                calls = self.stage_calls[stage]
+                stages[stage] = {'calls': calls,
+                                 'total_s': self.stage_time[stage],
+                                 'mean_us': self.stage_time[stage]/max(calls, 1)*1e6,
+                                 'max_us': self.stage_max[stage]*1e6}
+            return {'elapsed_s': time.perf_counter() - self.started,
+                    'stages': stages,
+                    'counters': dict(self.counters),
+                    'jitter_histogram': {'edges_us': list(self.JITTER_EDGES_US),
+                                         'counts': list(self.jitter_counts)}}
+
+class PatternCache:
+    '''
+    LRU cache of packed frames capped at max_bytes. The frames are kept as 
+    uint8 views of the helios_point_dtype points, copying a structured array 
+    goes field by field and is over 20x slower than copying its bytes.
+    '''
+    def __init__(self, max_bytes=32*2**20):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            buf = self.entries.get(key)
+            if(buf is None):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return buf
+
+    def put(self, key, buf):
+        # Too big to ever fit, do not flush everything else for it
+        if(buf.nbytes > self.max_bytes):
+            return
+        with self.lock:
+            if(key in self.entries):
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.entries[key] = buf
+            self.nbytes += buf.nbytes
+            while(self.nbytes > self.max_bytes):
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        Snapshot of the counters
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits/lookups if lookups else 0.0,
+                    'evictions': self.evictions}
+
+class FrameStream:
+    '''
+    A bounded ring of packed frames drained to the dac by a sender thread.
+    Producers call put from any thread. When the ring is full the policy decides:
+        'block'       - wait for space (up to timeout seconds if given)
+        'drop_oldest' - throw away the oldest queued frame
+        'drop_newest' - throw away the frame being put
+    An underrun is counted when the sender gets its next frame after the dacs 
+    were predicted (StatusPoller.play_end) to have finished the last one, 
+    so the output ran dry (or repeated a looping frame) waiting for it.
+    A frame that fails with a HeliosError (after DacQueue's retries) is counted 
+    and skipped, the sender carries on with the next one. Any other error stops 
+    the sender and is raised by the next put.
+    '''
+    policies = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, queue, capacity=8, policy='block'):
+        if(policy not in self.policies):
+            raise ValueError(f'Unknown policy {policy}, expected one of {self.policies}')
+        if(capacity < 1):
+            raise ValueError('capacity must be at least 1')
+        # DacQueue whose send_frame writes to the dac
+        self.queue = queue
+        self.capacity = capacity
+        self.policy = policy
+        self.ring = collections.deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        # Counters
+        self.frames_put = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.underruns = 0
+        self.max_depth = 0
+        self.send_errors = 0
+        self.last_error = None
+        # Set if the sender thread died
+        self.error = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='FrameStream', daemon=True)
+        self.thread.start()
+
+    def stop(self, drain=True):
+        with self.cond:
+            if(drain):
+                while(self.ring and self.thread.is_alive()):
+                    self.cond.wait()
+            self.running = False
+            self.ring.clear()
+            self.cond.notify_all()
+        self.thread.join()
+
+    def put(self, points, num_points, frame_rate, flags, timeout=None):
+        '''
+        Queues one packed frame. Returns False if the frame was dropped.
+        '''
+        with self.cond:
+            if(self.error is not None):
+                raise self.error
+            if(len(self.ring) >= self.capacity):
+                if(self.policy == 'drop_newest'):
+                    self.frames_dropped += 1
+                    return False
+                elif(self.policy == 'drop_oldest'):
+                    self.ring.popleft()
+                    self.frames_dropped += 1
+                else:
+                    ready = self.cond.wait_for(lambda: len(self.ring) < self.capacity or not self.running, timeout)
+                    if(not ready or not self.running):
+                        self.frames_dropped += 1
+                        return False
+            self.ring.append((points, num_points, frame_rate, flags))
+            self.frames_put += 1
+            self.max_depth = max(self.max_depth, len(self.ring))
+            self.cond.notify_all()
+        return True
+
+    def stats(self):
+        '''
+        Snapshot of the counters
+        '''
+        with self.cond:
+            return {'depth': len(self.ring),
+                    'max_depth': self.max_depth,
+                    'frames_put': self.frames_put,
+                    'frames_sent': self.frames_sent,
+                    'frames_dropped': self.frames_dropped,
+                    'underruns': self.underruns,
+                    'send_errors': self.send_errors,
+                    'last_error': None if self.last_error is None else str(self.last_error)}
+
+    def play_end(self):
+        '''
+        When the first of the queue's dacs is predicted to run out of frames
+        '''
+        return min(self.queue.pollers[dac_idx].play_end for dac_idx in self.queue.dac_indices)
+
+    def _run(self):
+        while(True):
+            with self.cond:
+                self.cond.wait_for(lambda: self.ring or not self.running)
+                if(not self.running):
+                    return
+                frame = self.ring.popleft()
+                if(self.frames_sent > 0 and time.perf_counter() > self.play_end()):
+                    self.underruns += 1
+                # Wake producers blocked on a full ring
+                self.cond.notify_all()
+            try:
+                self.queue.send_frame(*frame)
+            except HeliosError as e:
+                with self.cond:
+                    self.send_errors += 1
+                    self.last_error = e
+                    self.cond.notify_all()
+                continue
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.running = False
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.frames_sent += 1
+                self.cond.notify_all()
+
+def pack_frame(arr_pos, arr_col, intensity=255):
+    '''
+    Packs DAC-space positions (N,2) and colors (N,3) into a HeliosPoint frame.
+    The values are written column-wise into a structured numpy buffer and the 
+    returned ctypes array shares that memory, so nothing is copied on the way 
+    to WriteFrame. Out of range values wrap like the ctypes fields would.
+    '''
+    num_points = len(arr_pos)
+    buf = np.empty(num_points, dtype=helios_point_dtype)
+    buf['x'] = arr_pos[:, 0]
+    buf['y'] = arr_pos[:, 1]
+    buf['r'] = arr_col[:, 0]
+    buf['g'] = arr_col[:, 1]
+    buf['b'] = arr_col[:, 2]
+    buf['i'] = intensity
+    # The ctypes array keeps a reference to buf, so it outlives this call
+    points = (HeliosPoint * num_points).from_buffer(buf)
+    return points, num_points
+
+def split_frames(buf, max_points=HELIOS_MAX_POINTS):
+    '''
+    Splits a packed point buffer (helios_point_dtype) into as few frames 
+    as possible, each at most max_points long. The frames share memory with buf.
+    Returns a list of (points, num_points) like prep_pattern.
+    '''
+    frames = []
+    for start in range(0, len(buf), max_points):
+        chunk = buf[start:start+max_points]
+        frames.append(((HeliosPoint * len(chunk)).from_buffer(chunk), len(chunk)))
+    return frames
+
+class FusedTransform:
+    '''
+    position_corection, color_correction, the conversion to dac integers and 
+    pack_frame in one stage. Every step writes into scratch arrays that are 
+    kept between calls (grown as needed), so a frame only allocates numpy's 
+    view objects, about 1kB whatever the number of points.
+    The ops are rearranged only where that is exact in floating point, so 
+    the packed points are bit-identical to the separate functions.
+    Not thread safe, use one per packing thread.
+    '''
+    def __init__(self):
+        self.color_scale = 1-color_lower_cutoff
+        self.pos_scratch = np.empty((0, 2))
+        self.col_scratch = np.empty((0, 3))
+        self.shift_scratch = np.empty((0, 3))
+        self.mask_scratch = np.empty((0, 3), dtype=bool)
+        self.int_scratch = np.empty((0, 3), dtype=np.int32)
+        self.frac_scratch = np.empty(0)
+        self.ext_scratch = np.empty((0, 3))
+
+    def _reserve(self, num_points):
+        if(len(self.pos_scratch) < num_points):
+            # Grow geometrically so slowly growing patterns do not realloc every frame
+            size = max(num_points, 2*len(self.pos_scratch))
+            self.pos_scratch = np.empty((size, 2))
+            self.col_scratch = np.empty((size, 3))
+            self.shift_scratch = np.empty((size, 3))
+            self.mask_scratch = np.empty((size, 3), dtype=bool)
+            self.int_scratch = np.empty((size, 3), dtype=np.int32)
+            self.frac_scratch = np.empty(size)
+
+    def apply(self, arr_pos, arr_col, out, xy_max, max_scale=0.75, color_shifts=None, intensity=255, 
+              history=None, correct=True):
+        '''
+        Writes arr_pos (N,2) and arr_col (N,3) in unit space into out (N,) helios_point_dtype.
+        Colors are only corrected and shifted when color_shifts is given (not for gaps).
+        Without history the shifts wrap around like np.roll. With history, the 
+        (H,3) corrected colors that came before arr_col, they are a delay line instead 
+        (shifts must be >= 0 and reach back at most H samples). 
+        correct=False shifts the colors without correcting them.
+        '''
+        num_points = len(arr_pos)
+        self._reserve(num_points)
+        pos = self.pos_scratch[:num_points]
+        ints = self.int_scratch[:num_points]
+
+        # ((-p*max_scale+1)/2.0)*xy_max, negating and halving are exact so they fold into the factors
+        np.multiply(arr_pos, -max_scale, out=pos)
+        pos += 1
+        pos *= xy_max/2.0
+        np.copyto(ints[:, :2], pos, casting='unsafe')
+        out['x'] = ints[:, 0]
+        out['y'] = ints[:, 1]
+
+        col = self.col_scratch[:num_points]
+        if(color_shifts is None):
+            np.multiply(arr_col, 255, out=col)
+        else:
+            mask = self.mask_scratch[:num_points]
+            shifted = self.shift_scratch[:num_points]
+            if(correct):
+                # Per channel with scalars and zeroed through where, broadcasting the (3,) 
+                # factors over (N,3) or multiplying by the bool mask makes numpy fill an 
+                # iterator buffer of up to 64kB
+                np.less_equal(arr_col, 0, out=mask)
+                for col_idx in range(3):
+                    np.multiply(arr_col[:, col_idx], self.color_scale[col_idx], out=shifted[:, col_idx])
+                    shifted[:, col_idx] += color_lower_cutoff[col_idx]
+                np.copyto(shifted, 0, where=mask)
+            else:
+                np.copyto(shifted, arr_col)
+            if(history is not None):
+                self._delay_into(col, shifted, history, color_shifts)
+            # The roll lands each channel directly in its shifted place
+            for col_idx in range(3 if history is None else 0):
+                shift = color_shifts[col_idx] if col_idx < len(color_shifts) else 0
+                whole = int(np.floor(shift))
+                frac = shift - whole
+                _roll_into(col[:, col_idx], shifted[:, col_idx], whole)
+                if(frac):
+                    # Fractional delay: blend with the next sample back, like fractional_roll
+                    tmp = self.frac_scratch[:num_points]
+                    _roll_into(tmp, shifted[:, col_idx], whole+1)
+                    col[:, col_idx] *= 1-frac
+                    tmp *= frac
+                    col[:, col_idx] += tmp
+            col *= 255
+        np.copyto(ints, col, casting='unsafe')
+        out['r'] = ints[:, 0]
+        out['g'] = ints[:, 1]
+        out['b'] = ints[:, 2]
+        out['i'] = intensity
+        return out
+
+    def _delay_into(self, col, shifted, history, color_shifts):
+        '''
+        col[n] = shifted[n - shift] per channel, reaching back into history
+        '''
+        num_points = len(shifted)
+        hist_len = len(history)
+        if(len(self.ext_scratch) < hist_len + num_points):
+            self.ext_scratch = np.empty((hist_len + max(num_points, len(self.pos_scratch)), 3))
+        ext = self.ext_scratch[:hist_len+num_points]
+        ext[:hist_len] = history
+        ext[hist_len:] = shifted
+        for col_idx in range(3):
+            shift = color_shifts[col_idx] if col_idx < len(color_shifts) else 0
+            whole = int(np.floor(shift))
+            frac = shift - whole
+            if(whole < 0 or whole + (frac > 0) > hist_len):
+                raise ValueError(f'Color shift {shift} does not fit a history of {hist_len} samples')
+            start = hist_len - whole
+            col[:, col_idx] = ext[start:start+num_points, col_idx]
+            if(frac):
+                # Blend with the sample one further back, like fractional_roll
+                tmp = self.frac_scratch[:num_points]
+                np.multiply(ext[start-1:start-1+num_points, col_idx], frac, out=tmp)
+                col[:, col_idx] *= 1-frac
+                col[:, col_idx] += tmp
+
+def _roll_into(dst, src, shift):
+    '''
+    dst[:] = np.roll(src, shift) without the temporary
+    '''
+    num_points = len(src)
+    shift = shift % num_points if num_points else 0
+    dst[shift:] = src[:num_points-shift]
+    dst[:shift] = src[num_points-shift:]
+
+def fractional_roll(arr, shift):
+    '''
+    np.roll along the first axis by a shift that may be fractional, 
+    linearly interpolating between the two nearest whole shifts
+    '''
+    whole = int(np.floor(shift))
+    frac = shift - whole
+    rolled = np.roll(arr, whole, axis=0)
+    if(frac):
+        rolled = rolled*(1-frac) + np.roll(arr, whole+1, axis=0)*frac
+    return rolled
+
+@functools.lru_cache(maxsize=64)
+def color_shifts_for_rate(dac_rate, latency_us):
+    '''
+    Per channel sample shifts that delay colors by latency_us (microseconds) at dac_rate
+    '''
+    return tuple(latency*1e-6*dac_rate for latency in latency_us)
+
+# Lowest drive level (R, G, B) at which each laser diode actually emits
+color_lower_cutoff = np.array([0.25, 0.09, 0.09])
+
+def correct_colors(arr_col):
+    '''
+    The non-shifting part of color_correction
     '''
     non_zero = arr_col > 0
     # Scale to the lower cutoff (R, G, B)
-    lower_cutoff = np.array([0.25, 0.09, 0.09])
+    lower_cutoff = color_lower_cutoff
     arr_col = arr_col*(1-lower_cutoff) + lower_cutoff
     
     # Cutoff any zeros to ensure real black
     arr_col *= non_zero
+    return arr_col
+
+def color_correction(arr_col, color_shifts=[]):
+    '''
+    Corrects the nonlinearities in the color curve 
+    Color shifts correspond to [Red, Green, Blue], in samples (may be fractional)
+    '''
+    arr_col = correct_colors(arr_col)
     
     # Perform time shifting
     # Corresponds to Red, Green, Blue @ dac_rate 55k
     for col_idx, shift in enumerate(color_shifts):
-        arr_col[:, col_idx] = np.roll(arr_col[:, col_idx], shift, axis=0)
+        arr_col[:, col_idx] = fractional_roll(arr_col[:, col_idx], shift)
     
     return arr_col
 
-def position_corection(arr_pos):
+def position_corection(arr_pos, max_scale=0.75):
     '''
     Corrects x-y directions so that (x=-1,y=-1) is bottom left
     Scales the entire pattern so that it does not clip (amps are weird)
@@ -148,16 +1438,24 @@ def position_corection(arr_pos):
     # Reverse direction of x and y
     arr_pos *= -1
     
-    max_scale = 0.75
     return arr_pos*max_scale
     
 def make_circular(arr_pos, arr_color):
     return np.concatenate([arr_pos, arr_pos[::-1, :]]), np.concatenate([arr_color, arr_color[::-1, :]])
 
-def connect_in_space(arr_pos_list, angular_density=100, wait_per=None):
+def connect_in_space(arr_pos_list, angular_density=100, wait_per=None, 
+                     dac_rate=None, max_velocity=None, max_accel=None, profile='trapezoid'):
     '''
     Given a list of position arrays, produce a list of array positions that are connected
+    If dac_rate, max_velocity and max_accel are all given the gaps are limited 
+    moves from blank_moves (all generated in one batch) instead of linspaces.
     '''
+    limited = dac_rate and max_velocity and max_accel
+    if(limited):
+        starts = np.array([arr_pos[-1] for arr_pos in arr_pos_list[:-1]], dtype=float).reshape(-1, 2)
+        ends = np.array([arr_pos[0] for arr_pos in arr_pos_list[1:]], dtype=float).reshape(-1, 2)
+        moves, counts = blank_moves(starts, ends, dac_rate, max_velocity, max_accel, profile=profile)
+        moves = np.split(moves, np.cumsum(counts)[:-1])
     new_arr_pos_list = []
     for i in range(len(arr_pos_list)-1):
         # Get start/end positions for this gap
@@ -165,9 +1463,12 @@ def connect_in_space(arr_pos_list, angular_density=100, wait_per=None):
         pos_end = arr_pos_list[i+1][ 0, :].copy()
         
         # Make the transition
-        dist = np.sqrt(np.sum(np.power(pos_start-pos_end, 2)))
-        num_gap_points = int(dist*angular_density)
-        gap_pos = np.linspace(pos_start, pos_end, num_gap_points, dtype=float)
+        if(limited):
+            gap_pos = moves[i]
+        else:
+            dist = np.sqrt(np.sum(np.power(pos_start-pos_end, 2)))
+            num_gap_points = int(dist*angular_density)
+            gap_pos = np.linspace(pos_start, pos_end, num_gap_points, dtype=float)
         
         # If we have a wait period, add it to the end of the gap positions
         if(wait_per):
@@ -182,6 +1483,256 @@ def connect_in_space(arr_pos_list, angular_density=100, wait_per=None):
     
     return new_arr_pos_list
 
+def blank_moves(starts, ends, dac_rate, max_velocity, max_accel, profile='trapezoid'):
+    '''
+    Minimum point blanked moves for a batch of hops under galvo limits.
+    Each hop takes the shortest time its profile allows and is sampled once 
+    per dac point, the last sample landing exactly on the end position 
+    (a hop of zero length gets no points).
+        'trapezoid' - accelerate at max_accel, cruise at max_velocity, decelerate
+        's_curve'   - cycloidal move, acceleration ramps smoothly from and to zero
+    Inputs:
+        starts, ends - (K,2) hop start and end positions in unit space
+        dac_rate - points per second
+        max_velocity - unit space per second
+        max_accel - unit space per second squared
+    Returns the (N,2) positions of all hops back to back and the (K,) point count of each.
+    '''
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    dist = np.hypot(*(ends-starts).T)
+    if(profile == 'trapezoid'):
+        # Hops too short to reach max_velocity are triangular
+        peak_vel = np.minimum(max_velocity, np.sqrt(dist*max_accel))
+        accel_time = peak_vel/max_accel
+        move_time = np.where(dist > 0, 2*accel_time + (dist - peak_vel*accel_time)/np.maximum(peak_vel, 1e-300), 0)
+    elif(profile == 's_curve'):
+        # s(u) = u - sin(2 pi u)/(2 pi): peak velocity 2D/T, peak acceleration 2 pi D/T^2
+        move_time = np.maximum(2*dist/max_velocity, np.sqrt(2*np.pi*dist/max_accel))
+    else:
+        raise ValueError(f'Unknown profile {profile}')
+    counts = np.ceil(move_time*dac_rate - 1e-9).astype(int)
+
+    # One row per output point: which hop it belongs to and when it is sampled
+    hop = np.repeat(np.arange(len(dist)), counts)
+    step = np.arange(len(hop)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    t = np.minimum(step/dac_rate, move_time[hop])
+    if(profile == 'trapezoid'):
+        acc_t = accel_time[hop]
+        vel = peak_vel[hop]
+        total = move_time[hop]
+        acc_dist = 0.5*max_accel*acc_t**2
+        travelled = np.where(t < acc_t, 0.5*max_accel*t**2,
+                    np.where(t <= total-acc_t, acc_dist + vel*(t-acc_t),
+                             dist[hop] - 0.5*max_accel*(total-t)**2))
+        frac = travelled/np.maximum(dist[hop], 1e-300)
+    else:
+        u = t/np.maximum(move_time[hop], 1e-300)
+        frac = u - np.sin(2*np.pi*u)/(2*np.pi)
+    frac = np.clip(frac, 0, 1)
+    positions = starts[hop] + (ends[hop]-starts[hop])*frac[:, None]
+    return positions, counts
+
+def blank_move(pos_start, pos_end, dac_rate, max_velocity, max_accel, profile='trapezoid'):
+    '''
+    A single blanked move, see blank_moves
+    '''
+    positions, _ = blank_moves(np.reshape(pos_start, (1, 2)), np.reshape(pos_end, (1, 2)), 
+                               dac_rate, max_velocity, max_accel, profile=profile)
+    return positions
+
+def path_blank_points(arr_pos_list, angular_density=100, start_pos=None):
+    '''
+    Number of blanked gap points connect_in_space would put between the 
+    segments in the given order (plus the gap from start_pos, like submit, if given)
+    '''
+    if(len(arr_pos_list) == 0):
+        return 0
+    starts = np.array([arr_pos[0] for arr_pos in arr_pos_list], dtype=float)
+    ends = np.array([arr_pos[-1] for arr_pos in arr_pos_list], dtype=float)
+    dists = np.hypot(*(starts[1:]-ends[:-1]).T)
+    if(start_pos is not None):
+        dists = np.concatenate([np.hypot(*(starts[:1]-start_pos).T), dists])
+    return int(np.sum((dists*angular_density).astype(int)))
+
+def hilbert_index(arr_pos, bits=16):
+    '''
+    Position of each point (N,2) in unit space along a Hilbert curve through the square
+    '''
+    side = 2**bits
+    xy = ((np.clip(arr_pos, -1, 1)+1)/2*(side-1)).astype(np.int64)
+    x = xy[:, 0].copy()
+    y = xy[:, 1].copy()
+    d = np.zeros(len(arr_pos), dtype=np.int64)
+    s = side//2
+    while(s > 0):
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s*s*((3*rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, s-1-x, x)
+        y = np.where(flip, s-1-y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s //= 2
+    return d
+
+def optimize_path(arr_pos_list, arr_col_list=None, start_pos=None, angular_density=100, 
+                  allow_reverse=True, time_budget=0.01, nn_limit=256):
+    '''
+    Reorders (and if allow_reverse, reverses) segments to minimise the blanked 
+    travel connect_in_space has to add between them.
+    1) Builds a tour: nearest neighbour from start_pos for up to nn_limit segments,
+       otherwise Hilbert curve order with the best direction per segment
+    2) Improves it with 2-opt moves (which reverse runs of segments) until no 
+       move helps or time_budget seconds have passed in total
+    Inputs:
+        arr_pos_list - list of (N_i,2) position arrays
+        arr_col_list - optional matching list of (N_i,3) color arrays
+        start_pos - where the beam is before the first segment, free if None
+    Returns (arr_pos_list, arr_col_list, info) where info holds the order, 
+    which segments were reversed and the blanked points before and after.
+    '''
+    start_time = time.perf_counter()
+    num_segs = len(arr_pos_list)
+    if(num_segs == 0):
+        info = {'order': np.zeros(0, dtype=int),
+                'reversed': np.zeros(0, dtype=bool),
+                'blank_points_before': 0,
+                'blank_points_after': 0,
+                'blank_fraction_before': 0.0,
+                'blank_fraction_after': 0.0,
+                'time': time.perf_counter()-start_time}
+        return [], None if arr_col_list is None else [], info
+    starts = np.array([arr_pos[0] for arr_pos in arr_pos_list], dtype=float)
+    ends = np.array([arr_pos[-1] for arr_pos in arr_pos_list], dtype=float)
+    if(start_pos is not None):
+        start_pos = np.asarray(start_pos, dtype=float)
+
+    if(num_segs <= nn_limit):
+        order, flipped = _nearest_neighbour_tour(starts, ends, start_pos, allow_reverse)
+    else:
+        order = np.argsort(hilbert_index((starts+ends)/2), kind='stable')
+        flipped = _best_directions(starts[order], ends[order], start_pos, allow_reverse)
+    if(allow_reverse):
+        order, flipped = _two_opt(starts, ends, order, flipped, start_pos, 
+                                  start_time + time_budget)
+
+    new_pos_list = [arr_pos_list[i][::-1] if f else arr_pos_list[i] for i, f in zip(order, flipped)]
+    new_col_list = None
+    if(arr_col_list is not None):
+        new_col_list = [arr_col_list[i][::-1] if f else arr_col_list[i] for i, f in zip(order, flipped)]
+
+    num_drawn = sum(len(arr_pos) for arr_pos in arr_pos_list)
+    blank_before = path_blank_points(arr_pos_list, angular_density, start_pos)
+    blank_after = path_blank_points(new_pos_list, angular_density, start_pos)
+    info = {'order': np.asarray(order),
+            'reversed': np.asarray(flipped, dtype=bool),
+            'blank_points_before': blank_before,
+            'blank_points_after': blank_after,
+            'blank_fraction_before': blank_before/max(blank_before+num_drawn, 1),
+            'blank_fraction_after': blank_after/max(blank_after+num_drawn, 1),
+            'time': time.perf_counter()-start_time}
+    return new_pos_list, new_col_list, info
+
+def _nearest_neighbour_tour(starts, ends, start_pos, allow_reverse):
+    '''
+    Greedy tour, always jumping to the closest free segment end
+    '''
+    num_segs = len(starts)
+    # Candidate entry points: every start, then (if allowed) every end
+    entries = np.concatenate([starts, ends]) if allow_reverse else starts.copy()
+    free = np.ones(len(entries), dtype=bool)
+    order = []
+    flipped = []
+    cur = starts[0] if start_pos is None else start_pos
+    for _ in range(num_segs):
+        dist = np.sum((entries-cur)**2, axis=1)
+        dist[~free] = np.inf
+        idx = int(np.argmin(dist))
+        seg = idx % num_segs
+        flip = idx >= num_segs
+        free[seg] = False
+        if(allow_reverse):
+            free[seg+num_segs] = False
+        order.append(seg)
+        flipped.append(flip)
+        cur = starts[seg] if flip else ends[seg]
+    return np.array(order), np.array(flipped, dtype=bool)
+
+def _best_directions(starts, ends, start_pos, allow_reverse):
+    '''
+    For segments in a fixed order, picks the direction of each one that 
+    minimises the total travel (dynamic programming over both directions)
+    '''
+    num_segs = len(starts)
+    if(not allow_reverse or num_segs == 0):
+        return np.zeros(num_segs, dtype=bool)
+    # Travel between consecutive segments for each (from direction, to direction)
+    exits = [ends[:-1], starts[:-1]]
+    entries = [starts[1:], ends[1:]]
+    step = [[np.hypot(*(entries[t]-exits[f]).T).tolist() for t in range(2)] for f in range(2)]
+    if(start_pos is None):
+        cost = [0.0, 0.0]
+    else:
+        cost = [float(np.hypot(*(starts[0]-start_pos))), float(np.hypot(*(ends[0]-start_pos)))]
+    choice = []
+    for k in range(num_segs-1):
+        c0 = (cost[0]+step[0][0][k], cost[1]+step[1][0][k])
+        c1 = (cost[0]+step[0][1][k], cost[1]+step[1][1][k])
+        choice.append((int(c0[1] < c0[0]), int(c1[1] < c1[0])))
+        cost = [min(c0), min(c1)]
+    # Walk back from the cheaper final direction
+    flipped = np.zeros(num_segs, dtype=bool)
+    cur = int(cost[1] < cost[0])
+    for k in range(num_segs-1, -1, -1):
+        flipped[k] = cur
+        if(k > 0):
+            cur = choice[k-1][cur]
+    return flipped
+
+def _two_opt(starts, ends, order, flipped, start_pos, deadline):
+    '''
+    2-opt over oriented segments: reversing the run k..m flips every segment 
+    in it, so only the travel into k and out of m changes.
+    '''
+    order = np.array(order)
+    flipped = np.array(flipped, dtype=bool)
+    num_segs = len(order)
+    entry = np.where(flipped[:, None], ends[order], starts[order])
+    exit = np.where(flipped[:, None], starts[order], ends[order])
+    improved = True
+    while(improved and time.perf_counter() < deadline):
+        improved = False
+        # Travel out of every segment into the next one (none after the last)
+        out_dist = np.zeros(num_segs)
+        out_dist[:-1] = np.hypot(*(entry[1:]-exit[:-1]).T)
+        for k in range(num_segs):
+            if(time.perf_counter() > deadline):
+                break
+            prev = start_pos if k == 0 else exit[k-1]
+            # Travel into k now, and into the reversed run (which starts at exit[m])
+            if(prev is None):
+                in_dist = 0.0
+                new_in = np.zeros(num_segs-k)
+            else:
+                in_dist = np.hypot(*(entry[k]-prev))
+                new_in = np.hypot(*(exit[k:]-prev).T)
+            # After the reversed run comes entry[m+1], reached from entry[k]
+            new_out = np.zeros(num_segs-k)
+            new_out[:-1] = np.hypot(*(entry[k+1:]-entry[k]).T)
+            gain = in_dist + out_dist[k:] - new_in - new_out
+            m = int(np.argmax(gain))
+            if(gain[m] > 1e-9):
+                m += k
+                order[k:m+1] = order[k:m+1][::-1]
+                flipped[k:m+1] = ~flipped[k:m+1][::-1]
+                entry[k:m+1], exit[k:m+1] = exit[k:m+1][::-1].copy(), entry[k:m+1][::-1].copy()
+                out_dist[:-1] = np.hypot(*(entry[1:]-exit[:-1]).T)
+                improved = True
+    return order, flipped
+
 def fixed_interp(points, n_interp_points):
     '''
     Expands a list of points to a position array where those 
@@ -197,10 +1748,360 @@ def fixed_interp(points, n_interp_points):
         p1 = points[i]
         p2 = points[i+1]
         gap_pos = np.linspace(p1, p2, n_interp_points)
-        interped_pos_arr += [p1]
+        # Anchors as one row so they concatenate with the linspace rows
+        interped_pos_arr += [np.asarray(p1)[None]]
         interped_pos_arr += [gap_pos]
-    interped_pos_arr += [p2]
+    interped_pos_arr += [np.asarray(p2)[None]]
     
     # Convert them into one array 
     interped_pos_arr = np.concatenate(interped_pos_arr, axis=0)
     return interped_pos_arr
+
+def resample_paths(paths, dac_rate=30000, draw_time=None, spacing=None, corner_weight=0.0):
+    '''
+    Resamples many polylines at once into point arrays for the dac.
+    Points are spread evenly along each path's length plus corner_weight 
+    per radian of turning at every vertex, so with corner_weight > 0 the 
+    beam dwells at corners and moves fast on straight runs. For densely 
+    sampled curves the turning adds up to the curvature, so points follow it.
+    The number of points comes from either
+        draw_time - seconds to draw each path (scalar or one per path) at dac_rate
+        spacing - largest step along the path in unit space (straight runs)
+    Inputs:
+        paths - list of (M_i,2) polylines (M_i >= 1)
+    Returns a list of (N_i,2) position arrays, each starting and ending on its path's ends.
+    '''
+    if((draw_time is None) == (spacing is None)):
+        raise ValueError('Give exactly one of draw_time and spacing')
+    num_paths = len(paths)
+    if(num_paths == 0):
+        return []
+    lens = np.array([len(path) for path in paths])
+    verts = np.concatenate([np.asarray(path, dtype=float).reshape(-1, 2) for path in paths])
+    path_id = np.repeat(np.arange(num_paths), lens)
+    first = np.cumsum(lens) - lens
+    last = first + lens - 1
+
+    # Length of the segment leading into each vertex (0 at the start of a path)
+    step = np.zeros(len(verts))
+    step[1:] = np.hypot(*np.diff(verts, axis=0).T)
+    step[first] = 0
+    # Turning angle at each vertex (0 at both ends of a path)
+    turn = np.zeros(len(verts))
+    if(corner_weight > 0 and len(verts) > 2):
+        d_in = verts[1:-1] - verts[:-2]
+        d_out = verts[2:] - verts[1:-1]
+        cross = d_in[:, 0]*d_out[:, 1] - d_in[:, 1]*d_out[:, 0]
+        dot = np.sum(d_in*d_out, axis=1)
+        turn[1:-1] = np.abs(np.arctan2(cross, dot))
+        turn[first] = 0
+        turn[last] = 0
+
+    # Every vertex becomes two samples of the same point, corner_weight*turn apart 
+    # in the warped parameter, so points landing in between dwell on the corner
+    warp_step = np.empty(2*len(verts))
+    warp_step[0::2] = step
+    warp_step[1::2] = corner_weight*turn
+    # Paths are kept apart by one unit so a target never falls between two of them
+    warp_step[2*first[1:]] += 1.0
+    warp = np.cumsum(warp_step)
+    warp_verts = np.repeat(verts, 2, axis=0)
+    path_start = warp[2*first]
+    path_len = warp[2*last+1] - path_start
+
+    if(draw_time is not None):
+        num_points = np.broadcast_to(np.round(np.asarray(draw_time)*dac_rate), (num_paths,)).astype(int)
+    else:
+        num_points = np.ceil(path_len/spacing).astype(int) + 1
+    num_points = np.maximum(num_points, 2)
+
+    # Evenly spaced targets along each warped path, all paths in one interpolation
+    out_id = np.repeat(np.arange(num_paths), num_points)
+    out_idx = np.arange(len(out_id)) - np.repeat(np.cumsum(num_points) - num_points, num_points)
+    target = path_start[out_id] + path_len[out_id]*out_idx/(num_points[out_id]-1)
+    resampled = np.stack([np.interp(target, warp, warp_verts[:, 0]), 
+                          np.interp(target, warp, warp_verts[:, 1])], axis=1)
+    return np.split(resampled, np.cumsum(num_points)[:-1])
+
+def resample_path(path, dac_rate=30000, draw_time=None, spacing=None, corner_weight=0.0, samples=1024):
+    '''
+    Resamples one path, see resample_paths. 
+    path is either an (M,2) polyline or a function mapping u in [0,1] to (len(u),2) positions,
+    which is sampled at samples points first.
+    '''
+    if(callable(path)):
+        path = path(np.linspace(0, 1, samples))
+    return resample_paths([path], dac_rate=dac_rate, draw_time=draw_time, spacing=spacing, 
+                          corner_weight=corner_weight)[0]
+
+class PointScan:
+    '''
+    Base of scans that are one stream of points (arr_pos, arr_col) with
+    pixel_of_point mapping every point to the flat index (row*num_cols + col)
+    of the pixel it lights, or -1 while the laser is off. Subclasses set those
+    and num_cols, num_rows. Use submit to send it and pixel_at_times to map
+    sensor samples back to pixels.
+    '''
+    def __len__(self):
+        return len(self.arr_pos)
+
+    def duration(self, dac_rate):
+        return len(self.arr_pos)/dac_rate
+
+    def submit(self, queue, on_start=None):
+        '''
+        Sends the scan through a DacQueue (after the gap from the queue's last 
+        position), split into frames of up to HELIOS_MAX_POINTS that each play once.
+        Returns the predicted time.perf_counter() the first point of the scan is 
+        drawn, from the dac's status poller. That is only known when the queue 
+        writes on the calling thread to a single dac, otherwise None is returned.
+        on_start is called with it as soon as the first frame is written.
+        '''
+        buf = queue.prep_stream(self.arr_pos, self.arr_col)
+        num_gap_points = len(buf) - len(self.arr_pos)
+        start_time = None
+        for points, num_points in split_frames(buf):
+            queue.write_frames(points, num_points, do_not_loop=True)
+            if(start_time is None and queue.stream is None and len(queue.dac_indices) == 1):
+                poller = queue.pollers[queue.dac_indices[0]]
+                start_time = poller.play_end + (num_gap_points - num_points)/queue.dac_rate
+                if(on_start is not None):
+                    on_start(start_time)
+        return start_time
+
+    def point_times(self, start_time, dac_rate):
+        '''
+        The time each point is drawn, given the time of the first one
+        '''
+        return start_time + np.arange(len(self.arr_pos))/dac_rate
+
+    def pixel_at_times(self, times, start_time, dac_rate):
+        '''
+        Flat pixel index lit at each of times, -1 when none is (overscan, turnaround, before or after)
+        '''
+        point_idx = np.floor((np.asarray(times) - start_time)*dac_rate).astype(int)
+        inside = (point_idx >= 0) & (point_idx < len(self.arr_pos))
+        return np.where(inside, self.pixel_of_point[np.clip(point_idx, 0, len(self.arr_pos) - 1)], -1)
+
+class RasterScan(PointScan):
+    '''
+    A whole raster of num_cols x num_rows pixels as one stream of points, 
+    for scanning a scene pixel by pixel (dual photography).
+    Each pixel is held for dwell samples with the laser on (color). Rows are 
+    extended by overscan (fraction of the row width) on both ends with the laser 
+    off, so the galvos are up to speed before the first pixel. With serpentine 
+    every other row runs backwards, so a row only needs a short turnaround 
+    instead of a rewind. The turnaround (turnaround_points samples, laser off) is
+        'linear' - a straight line to the start of the next row
+        'cosine' - the same line, eased in and out
+        'arc'    - a half circle beyond the row's end (serpentine only)
+    pixel_of_point maps every point to its flat pixel index (row*num_cols + col), 
+    or -1 for overscan and turnaround points. Use submit to send it and 
+    pixel_times / pixel_at_times to map sensor samples back to pixels.
+    '''
+    turnarounds = ('linear', 'cosine', 'arc')
+
+    def __init__(self, num_cols, num_rows, x_range=(-1.0, 1.0), y_range=(-1.0, 1.0), dwell=1, 
+                 overscan=0.0, turnaround='cosine', turnaround_points=16, serpentine=True, color=(1.0, 1.0, 1.0)):
+        if(turnaround not in self.turnarounds):
+            raise ValueError(f'Unknown turnaround {turnaround}, expected one of {self.turnarounds}')
+        if(turnaround == 'arc' and not serpentine):
+            raise ValueError('The arc turnaround needs serpentine rows')
+        if(num_cols < 1 or num_rows < 1 or dwell < 1):
+            raise ValueError('num_cols, num_rows and dwell must be at least 1')
+        if(num_cols == 1 and overscan > 0):
+            raise ValueError('overscan needs at least two columns, a single column has no row width')
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+        self.dwell = dwell
+        xs = np.linspace(x_range[0], x_range[1], num_cols)
+        ys = np.linspace(y_range[0], y_range[1], num_rows)
+        pitch = (xs[-1] - xs[0])/(num_cols - 1) if num_cols > 1 else 0.0
+        num_over = int(round(overscan*num_cols))
+        # Forward rows run towards +x unless x_range is descending
+        forward_x = -1.0 if pitch < 0 else 1.0
+
+        # Column coordinate of every sample of a forward row, overscan included
+        row_u = np.repeat(np.arange(-num_over, num_cols + num_over), dwell)
+        row_lit = (row_u >= 0) & (row_u < num_cols)
+        pos_parts = []
+        pix_parts = []
+        for row_idx in range(num_rows):
+            backwards = serpentine and row_idx % 2 == 1
+            u = row_u[::-1] if backwards else row_u
+            lit = row_lit[::-1] if backwards else row_lit
+            row_pos = np.empty((len(u), 2))
+            row_pos[:, 0] = xs[0] + u*pitch
+            row_pos[:, 1] = ys[row_idx]
+            pos_parts.append(row_pos)
+            pix_parts.append(np.where(lit, row_idx*num_cols + u, -1))
+            if(row_idx < num_rows - 1 and turnaround_points > 0):
+                next_backwards = serpentine and (row_idx + 1) % 2 == 1
+                next_u = row_u[-1] if next_backwards else row_u[0]
+                next_start = np.array([xs[0] + next_u*pitch, ys[row_idx + 1]])
+                turn_pos = self.turnaround(row_pos[-1], next_start, turnaround, turnaround_points, 
+                                           direction=-forward_x if backwards else forward_x)
+                pos_parts.append(turn_pos)
+                pix_parts.append(np.full(len(turn_pos), -1))
+        self.arr_pos = np.concatenate(pos_parts)
+        self.pixel_of_point = np.concatenate(pix_parts)
+        lit = self.pixel_of_point >= 0
+        self.arr_col = np.zeros((len(self.arr_pos), 3))
+        self.arr_col[lit] = color
+        # Index of the first point of every pixel
+        lit_idx = np.flatnonzero(lit)
+        _, first = np.unique(self.pixel_of_point[lit_idx], return_index=True)
+        self.pixel_start = lit_idx[first]
+
+    @staticmethod
+    def num_points(num_cols, num_rows, dwell=1, overscan=0.0, turnaround_points=16):
+        '''
+        Length of the RasterScan with these arguments, without building it
+        '''
+        num_over = int(round(overscan*num_cols))
+        return num_rows*(num_cols + 2*num_over)*dwell + (num_rows - 1)*turnaround_points
+
+    @staticmethod
+    def turnaround(start, end, profile, num_points, direction=1.0):
+        '''
+        num_points between start and end (both excluded) along profile
+        '''
+        t = np.arange(1, num_points + 1)/(num_points + 1)
+        if(profile == 'linear'):
+            s = t
+        else:
+            s = (1 - np.cos(np.pi*t))/2
+        turn_pos = start + s[:, None]*(end - start)
+        if(profile == 'arc'):
+            # Bulge out past the row end by half the row step
+            radius = np.abs(end[1] - start[1])/2
+            turn_pos[:, 0] += direction*radius*np.sin(np.pi*t)
+        return turn_pos
+
+    def pixel_times(self, start_time, dac_rate):
+        '''
+        (num_rows, num_cols, 2) start and end time the laser is on each pixel
+        '''
+        starts = start_time + self.pixel_start/dac_rate
+        times = np.stack([starts, starts + self.dwell/dac_rate], axis=-1)
+        return times.reshape(self.num_rows, self.num_cols, 2)
+
+class PixelScan(PointScan):
+    '''
+    Visits only some pixels (flat indices into a num_cols x num_rows grid 
+    like RasterScan's), each for dwell samples with the laser on, for 
+    adaptive scans. The pixels are drawn row by row, alternating direction, 
+    with transit_step (unit space, default two pixel pitches) spaced blank 
+    points of a cosine move between pixels that are further apart.
+    '''
+    def __init__(self, pixels, num_cols, num_rows, x_range=(-1.0, 1.0), y_range=(-1.0, 1.0), dwell=1, 
+                 transit_step=None, color=(1.0, 1.0, 1.0)):
+        if(num_cols < 1 or num_rows < 1 or dwell < 1):
+            raise ValueError('num_cols, num_rows and dwell must be at least 1')
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+        self.dwell = dwell
+        self.xs = np.linspace(x_range[0], x_range[1], num_cols)
+        self.ys = np.linspace(y_range[0], y_range[1], num_rows)
+        self.transit_step = self.default_transit_step(self.xs, self.ys) if transit_step is None else transit_step
+        self.pixels = self.serpentine_order(np.unique(np.asarray(pixels, dtype=np.int64)), num_cols)
+        self.arr_pos, self.pixel_of_point = self.path(self.pixels, self.xs, self.ys, dwell, self.transit_step)
+        self.arr_col = np.zeros((len(self.arr_pos), 3))
+        self.arr_col[self.pixel_of_point >= 0] = color
+
+    @staticmethod
+    def default_transit_step(xs, ys):
+        pitches = [abs(axis[1] - axis[0]) for axis in (xs, ys) if len(axis) > 1]
+        return 2*min(pitches) if pitches and min(pitches) > 0 else 1.0
+
+    @staticmethod
+    def serpentine_order(pixels, num_cols):
+        '''
+        pixels sorted by row, every other row backwards
+        '''
+        rows = pixels//num_cols
+        cols = pixels % num_cols
+        return pixels[np.lexsort((np.where(rows % 2 == 1, -cols, cols), rows))]
+
+    @staticmethod
+    def path(pixels, xs, ys, dwell, transit_step, close=False):
+        '''
+        Points visiting pixels in order, dwell each, and the pixel of every 
+        point (-1 for the blank moves). With close the path moves back to 
+        the first pixel at the end, so it can be repeated.
+        '''
+        num_cols = len(xs)
+        num_pixels = len(pixels)
+        pos = np.column_stack([xs[pixels % num_cols], ys[pixels//num_cols]])
+        # Blank points after every pixel, towards the next one
+        next_idx = np.arange(1, num_pixels + 1) % max(num_pixels, 1)
+        dist = np.linalg.norm(pos[next_idx] - pos, axis=1)
+        num_transit = np.floor(dist/transit_step).astype(int)
+        if(not close and num_pixels):
+            num_transit[-1] = 0
+        block = dwell + num_transit
+        starts = np.cumsum(block) - block
+        arr_pos = np.empty((int(np.sum(block)), 2))
+        pixel_of_point = np.full(len(arr_pos), -1)
+        lit_idx = (starts[:, None] + np.arange(dwell)).ravel()
+        arr_pos[lit_idx] = np.repeat(pos, dwell, axis=0)
+        pixel_of_point[lit_idx] = np.repeat(pixels, dwell)
+        seg = np.repeat(np.arange(num_pixels), num_transit)
+        k = np.arange(len(seg)) - np.repeat(np.cumsum(num_transit) - num_transit, num_transit) + 1
+        t = k/(num_transit[seg] + 1)
+        s = (1 - np.cos(np.pi*t))/2
+        arr_pos[starts[seg] + dwell + k - 1] = pos[seg] + s[:, None]*(pos[next_idx[seg]] - pos[seg])
+        return arr_pos, pixel_of_point
+
+class PatternScan(PointScan):
+    '''
+    Draws structured patterns (a (num_patterns, num_rows, num_cols) bool array 
+    of lit pixels), for single pixel imaging: a sensor exposed for one period 
+    of a pattern measures the sum of the scene over its lit pixels.
+    Every pattern is drawn as a closed PixelScan path (dwell samples per lit 
+    pixel), padded with blank points to period samples (default the longest 
+    path), repeated repeats times. So exposures of period/dac_rate seconds 
+    inside a pattern integrate it exactly. Here pixel_of_point is the pattern 
+    index (num_rows=1, num_cols=num_patterns), -1 during the blank move from 
+    one pattern to the next, so match_samples gives the measurement per pattern.
+    '''
+    def __init__(self, patterns, x_range=(-1.0, 1.0), y_range=(-1.0, 1.0), dwell=1, repeats=3, period=None, 
+                 transit_step=None, color=(1.0, 1.0, 1.0)):
+        patterns = np.asarray(patterns, dtype=bool)
+        num_patterns, grid_rows, grid_cols = patterns.shape
+        self.num_rows = 1
+        self.num_cols = num_patterns
+        self.dwell = dwell
+        self.repeats = repeats
+        xs = np.linspace(x_range[0], x_range[1], grid_cols)
+        ys = np.linspace(y_range[0], y_range[1], grid_rows)
+        if(transit_step is None):
+            transit_step = PixelScan.default_transit_step(xs, ys)
+        paths = []
+        for pattern in patterns:
+            pixels = PixelScan.serpentine_order(np.flatnonzero(pattern), grid_cols)
+            paths.append(PixelScan.path(pixels, xs, ys, dwell, transit_step, close=True))
+        longest = max(len(arr_pos) for arr_pos, _ in paths)
+        self.period = longest if period is None else period
+        if(self.period < longest):
+            raise ValueError(f'period {self.period} is shorter than the longest pattern ({longest} points)')
+        pos_parts = []
+        col_parts = []
+        pix_parts = []
+        last_pos = np.array([xs[0], ys[0]])
+        for pattern_idx, (arr_pos, pixel_of_point) in enumerate(paths):
+            # Parked at the start between repetitions, or where the last pattern ended if nothing is lit
+            park = arr_pos[0] if len(arr_pos) else last_pos
+            period_pos = np.empty((self.period, 2))
+            period_pos[:len(arr_pos)] = arr_pos
+            period_pos[len(arr_pos):] = park
+            period_col = np.zeros((self.period, 3))
+            period_col[:len(arr_pos)][pixel_of_point >= 0] = color
+            lead_in = RasterScan.turnaround(last_pos, park, 'cosine', int(np.linalg.norm(park - last_pos)/transit_step))
+            pos_parts += [lead_in, np.tile(period_pos, (repeats, 1))]
+            col_parts += [np.zeros((len(lead_in), 3)), np.tile(period_col, (repeats, 1))]
+            pix_parts += [np.full(len(lead_in), -1), np.full(repeats*self.period, pattern_idx)]
+            last_pos = park
+        self.arr_pos = np.concatenate(pos_parts)
+        self.arr_col = np.concatenate(col_parts)
+        self.pixel_of_point = np.concatenate(pix_parts)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark for writing to several Helios DACs from one DacQueue.
+
+Uses the simulated library (helios_sim), so no DACs are needed. One of the
+simulated DACs has a slower link. Waiting for it holds the fast DACs back to
+its pace, dropping its frames when it falls behind (DacQueue drop_lagging)
+lets them run at their own. Throughput is measured until each DAC has played
+its last frame (the simulated play_end), not until the write was accepted,
+so the double buffer cannot push it over the frame rate.
+"""
+
+import time
+import numpy as np
+import laser_lib
+import helios_sim
+
+def serial_writes(queue, frames, frame_rate):
+    '''
+    One dac after the other on the calling thread, like first_project.py
+    '''
+    for points, num_points in frames:
+        for dac_idx in queue.dac_indices:
+            queue.send_frame_to(dac_idx, points, num_points, frame_rate, 0)
+
+def parallel_writes(queue, frames, frame_rate):
+    for points, num_points in frames:
+        queue.send_frame(points, num_points, frame_rate, 0)
+    queue.flush()
+
+if __name__ == "__main__":
+    num_devices = 4
+    num_frames = 20
+    frame_rate = 65000
+    rng = np.random.default_rng(0)
+    for num_points in [500, 2000, 4096]:
+        arr_pos = rng.integers(0, 4096, size=(num_points, 2))
+        arr_col = rng.integers(0, 256, size=(num_points, 3))
+        frames = [laser_lib.pack_frame(arr_pos, arr_col) for _ in range(num_frames)]
+        for name, write_fn, drop_lagging in [('Serial', serial_writes, False),
+                                             ('Parallel, waiting', parallel_writes, False),
+                                             ('Parallel, dropping', parallel_writes, True)]:
+            # Full speed USB for all but the last device, which gets a quarter of it
+            lib = helios_sim.SimulatedHeliosLib(num_devices, [1e6]*(num_devices-1) + [0.25e6], record=False)
+            queue = laser_lib.DacQueue(dac=laser_lib.Dac(lib=lib), dac_indices=range(num_devices),
+                                       drop_lagging=drop_lagging)
+            start_time = time.perf_counter()
+            write_fn(queue, frames, frame_rate)
+            duration_s = time.perf_counter() - start_time
+            stats = [lib.stats(dac_idx) for dac_idx in range(num_devices)]
+            # Each dac's throughput until it played the last frame it got (once)
+            pps = [stats[dac_idx]['points']/(stats[dac_idx]['play_end'] - start_time) for dac_idx in range(num_devices)]
+            pps_fast = np.mean(pps[:-1])
+            pps_slow = pps[-1]
+            print(f'NumPoints: {num_points}\t{name:18s}: {duration_s:.3f}s\t'
+                  f'PPS per fast dac: {pps_fast:,.0f}\tPPS slow dac: {pps_slow:,.0f}\t'
+                  f'slow dac dropped {queue.device_drops[num_devices-1]} of {num_frames} frames')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark for packing frames into HeliosPoint buffers.
+
+Compares the old per-point ctypes loop against laser_lib.pack_frame.
+Does not need a DAC or the Helios library.
+"""
+
+import time
+import numpy as np
+import laser_lib
+
+def pack_frame_loop(arr_pos, arr_col):
+    '''
+    The original prep_pattern packing loop, one HeliosPoint per point
+    '''
+    num_points = len(arr_pos)
+    frameType = laser_lib.HeliosPoint * num_points
+    points = frameType()
+    for idx in range(num_points):
+        points[idx] =     laser_lib.HeliosPoint(int(arr_pos[idx, 0]),
+                                                int(arr_pos[idx, 1]),
+                                                int(arr_col[idx, 0]),
+                                                int(arr_col[idx, 1]),
+                                                int(arr_col[idx, 2]),
+                                                int(255))
+    return points, num_points
+
+def points_per_second(pack_fn, arr_pos, arr_col, min_time=0.5):
+    '''
+    Repeats pack_fn for at least min_time seconds and returns points packed per second
+    '''
+    reps = 0
+    start_time = time.perf_counter()
+    while(True):
+        pack_fn(arr_pos, arr_col)
+        reps += 1
+        duration_s = time.perf_counter() - start_time
+        if(duration_s > min_time):
+            break
+    return reps*len(arr_pos)/duration_s
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for num_points in [100, 1000, 4096]:
+        arr_pos = rng.integers(0, 4096, size=(num_points, 2)).astype(np.int32)
+        arr_col = rng.integers(0, 256, size=(num_points, 3)).astype(np.int32)
+
+        # Both paths must produce the same bytes
+        loop_points, _ = pack_frame_loop(arr_pos, arr_col)
+        vec_points, _ = laser_lib.pack_frame(arr_pos, arr_col)
+        assert bytes(loop_points) == bytes(vec_points)
+
+        pps_loop = points_per_second(pack_frame_loop, arr_pos, arr_col)
+        pps_vec = points_per_second(laser_lib.pack_frame, arr_pos, arr_col)
+        print(f'NumPoints: {num_points}\tLoop: {pps_loop:,.0f} pts/s\tVectorized: {pps_vec:,.0f} pts/s\tSpeedup: {pps_vec/pps_loop:.1f}x')
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+Photodiode reader for the Arduino serial link used in dual photography.
+
+The Arduino sends samples in binary frames (all fields little endian uint16):
+
+    sync (0xA55A) | seq | count | count samples | checksum
+
+seq counts frames (wrapping at 65536) so lost frames can be detected, and
+checksum is the 16 bit sum of seq, count and the samples. On the Arduino:
+
+    void sendFrame(uint16_t seq, uint16_t *samples, uint16_t count) {
+      uint16_t sum = seq + count;
+      for (uint16_t i = 0; i < count; i++) sum += samples[i];
+      uint16_t header[3] = {0xA55A, seq, count};
+      Serial.write((uint8_t*)header, 6);
+      Serial.write((uint8_t*)samples, 2*count);
+      Serial.write((uint8_t*)&sum, 2);
+    }
+
+FrameParser decodes whole frames with np.frombuffer and skips to the next sync
+word after corrupt bytes instead of giving up. AsciiParser does the same for
+the old one number per line protocol. PhotodiodeReader reads the serial port
+in bulk on a background thread into a ring buffer, filling the place of lost
+frames with MISSING_SAMPLE so the samples after them do not shift. MemorySerial is an in memory
+stand-in for serial.Serial for testing without an Arduino.
+
+Run this file for a throughput test over MemorySerial with corrupted bytes.
+"""
+
+import threading
+import time
+import numpy as np
+
+SYNC_WORD = 0xA55A
+# Stands in for a sample that could not be parsed (the ADC only goes to 1023)
+MISSING_SAMPLE = 0xFFFF
+SYNC_BYTES = SYNC_WORD.to_bytes(2, 'little')
+# sync, seq, count
+HEADER_BYTES = 6
+CHECKSUM_BYTES = 2
+
+def encode_frame(seq, samples):
+    '''
+    Bytes of one binary frame, like the Arduino sends it
+    '''
+    samples = np.asarray(samples, dtype='<u2')
+    seq = seq & 0xFFFF
+    checksum = (seq + len(samples) + int(np.sum(samples, dtype=np.uint64))) & 0xFFFF
+    header = np.array([SYNC_WORD, seq, len(samples)], dtype='<u2')
+    return header.tobytes() + samples.tobytes() + np.uint16(checksum).astype('<u2').tobytes()
+
+class FrameParser:
+    '''
+    Incremental decoder of the binary frames. feed() takes any chunk of
+    bytes and returns the (seq, samples) of every complete frame in it.
+    Frames claiming more than max_samples or with a bad checksum are
+    skipped by searching for the next sync word after their first byte.
+    '''
+    def __init__(self, max_samples=1024):
+        self.max_samples = max_samples
+        self.buf = bytearray()
+        self.last_seq = None
+        # Counters
+        self.frames = 0
+        self.samples = 0
+        self.bad_checksums = 0
+        self.bad_counts = 0
+        self.skipped_bytes = 0
+        self.lost_frames = 0
+
+    def feed(self, data):
+        self.buf += data
+        frames = []
+        pos = 0
+        buf = self.buf
+        while(True):
+            sync = buf.find(SYNC_BYTES, pos)
+            if(sync < 0):
+                # Keep a last byte that may be the start of a sync word
+                keep = 1 if buf[-1:] == SYNC_BYTES[:1] else 0
+                self.skipped_bytes += len(buf) - pos - keep
+                pos = len(buf) - keep
+                break
+            self.skipped_bytes += sync - pos
+            pos = sync
+            if(len(buf) - pos < HEADER_BYTES):
+                break
+            seq = int.from_bytes(buf[pos+2:pos+4], 'little')
+            count = int.from_bytes(buf[pos+4:pos+6], 'little')
+            if(count > self.max_samples):
+                self.bad_counts += 1
+                self.skipped_bytes += 1
+                pos += 1
+                continue
+            frame_bytes = HEADER_BYTES + 2*count + CHECKSUM_BYTES
+            if(len(buf) - pos < frame_bytes):
+                break
+            # A copy of the frame, so the buffer can be resized while the samples live on
+            words = np.frombuffer(bytes(buf[pos+2:pos+frame_bytes]), dtype='<u2')
+            # words: seq, count, samples..., checksum
+            if((int(np.sum(words[:-1], dtype=np.uint64)) & 0xFFFF) != words[-1]):
+                self.bad_checksums += 1
+                self.skipped_bytes += 1
+                pos += 1
+                continue
+            if(self.last_seq is not None):
+                self.lost_frames += (seq - self.last_seq - 1) & 0xFFFF
+            self.last_seq = seq
+            frames.append((seq, words[2:-1]))
+            self.frames += 1
+            self.samples += count
+            pos += frame_bytes
+        del buf[:pos]
+        return frames
+
+    def stats(self):
+        return {'frames': self.frames,
+                'samples': self.samples,
+                'bad_checksums': self.bad_checksums,
+                'bad_counts': self.bad_counts,
+                'skipped_bytes': self.skipped_bytes,
+                'lost_frames': self.lost_frames}
+
+class AsciiParser:
+    '''
+    Incremental decoder of the old protocol, one decimal number per line.
+    Lines that are not a number are counted and become MISSING_SAMPLE, so
+    later samples keep their place in a batch (with skip_bad, they are dropped).
+    feed() returns [(None, samples)] like FrameParser.
+    '''
+    def __init__(self, skip_bad=False):
+        self.skip_bad = skip_bad
+        self.buf = b''
+        self.samples = 0
+        self.bad_lines = 0
+
+    def feed(self, data):
+        lines = (self.buf + data).split(b'\n')
+        # The last piece is an unfinished line
+        self.buf = lines.pop()
+        values = []
+        for line in lines:
+            line = line.strip()
+            if(line.isdigit()):
+                values.append(int(line))
+            elif(line):
+                self.bad_lines += 1
+                if(not self.skip_bad):
+                    values.append(MISSING_SAMPLE)
+        if(not values):
+            return []
+        self.samples += len(values)
+        return [(None, np.array(values, dtype=np.uint16))]
+
+    def stats(self):
+        return {'samples': self.samples, 'bad_lines': self.bad_lines}
+
+class PhotodiodeReader:
+    '''
+    Reads a serial port (serial.Serial or MemorySerial) on a background thread,
+    decodes it with parser (FrameParser by default) and keeps the last
+    capacity samples, with their arrival times, in a ring buffer.
+    With sample_rate the samples of a frame are timestamped sample_rate apart,
+    ending at the frame's arrival, otherwise they all get the arrival time.
+    A gap in the frame seq numbers (corrupt or dropped frames) is filled with 
+    MISSING_SAMPLE, as many as the lost frames would have held going by the 
+    next frame's count, so a lost frame reads as NaNs (to_voltage) instead of 
+    shifting every later sample.
+    read(n) hands out samples in order, latest(n) peeks at the newest ones.
+    Samples that are overwritten before they are read are counted as overruns.
+    '''
+    def __init__(self, ser, parser=None, capacity=2**16, read_size=4096, sample_rate=None):
+        self.ser = ser
+        self.parser = FrameParser() if parser is None else parser
+        self.capacity = capacity
+        self.read_size = read_size
+        self.sample_rate = sample_rate
+        self.values = np.zeros(capacity, dtype=np.uint16)
+        self.times = np.zeros(capacity)
+        # Total samples written and read, the ring index is the count modulo capacity
+        self.written = 0
+        self.read_count = 0
+        self.overruns = 0
+        # Seq of the last frame, and the MISSING_SAMPLEs written for lost ones
+        self.last_seq = None
+        self.missing = 0
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='PhotodiodeReader', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if(self.thread is not None):
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run(self):
+        try:
+            while(self.running):
+                # Block for the first byte (up to the port's timeout), then take whatever else is waiting
+                data = self.ser.read(max(1, min(self.read_size, self.ser.in_waiting)))
+                if(not data):
+                    continue
+                arrival = time.perf_counter()
+                for seq, samples in self.parser.feed(data):
+                    num_missing = 0
+                    if(seq is not None):
+                        if(self.last_seq is not None):
+                            num_missing = ((seq - self.last_seq - 1) & 0xFFFF)*len(samples)
+                        self.last_seq = seq
+                    self.push(samples, arrival, num_missing)
+        except Exception as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def push(self, samples, arrival, num_missing=0):
+        '''
+        Writes num_missing MISSING_SAMPLEs and then samples to the ring
+        '''
+        num_samples = num_missing + len(samples)
+        # Only the tail of more than the ring holds is kept, at the end of where all of it goes
+        num_kept = min(num_samples, self.capacity)
+        if(num_kept > len(samples)):
+            samples = np.concatenate([np.full(num_kept - len(samples), MISSING_SAMPLE, dtype=np.uint16), samples])
+        else:
+            samples = samples[len(samples)-num_kept:]
+        if(self.sample_rate):
+            times = arrival - np.arange(num_kept - 1, -1, -1)/self.sample_rate
+        else:
+            times = np.full(num_kept, arrival)
+        with self.cond:
+            idx = (self.written + num_samples - num_kept + np.arange(num_kept)) % self.capacity
+            self.values[idx] = samples
+            self.times[idx] = times
+            self.written += num_samples
+            self.missing += num_missing
+            # The oldest unread samples were overwritten
+            if(self.written - self.read_count > self.capacity):
+                self.overruns += self.written - self.read_count - self.capacity
+                self.read_count = self.written - self.capacity
+            self.cond.notify_all()
+
+    def read(self, num_samples, timeout=None):
+        '''
+        The next num_samples samples and their times, waiting up to timeout seconds
+        for them. Returns fewer if the timeout runs out.
+        '''
+        num_samples = min(num_samples, self.capacity)
+        with self.cond:
+            self.cond.wait_for(lambda: self.written - self.read_count >= num_samples or self.error is not None,
+                               timeout)
+            if(self.error is not None):
+                raise self.error
+            available = min(num_samples, self.written - self.read_count)
+            idx = (self.read_count + np.arange(available)) % self.capacity
+            self.read_count += available
+            return self.values[idx].copy(), self.times[idx].copy()
+
+    def latest(self, num_samples):
+        '''
+        The newest num_samples samples and times, without consuming them
+        '''
+        with self.cond:
+            available = min(num_samples, self.written, self.capacity)
+            idx = (self.written - available + np.arange(available)) % self.capacity
+            return self.values[idx].copy(), self.times[idx].copy()
+
+    def stats(self):
+        with self.cond:
+            stats = {'written': self.written, 'read': self.read_count,
+                     'buffered': self.written - self.read_count, 'overruns': self.overruns,
+                     'missing': self.missing}
+        stats.update(self.parser.stats())
+        return stats
+
+def to_voltage(samples, ref_voltage=5.0, adc_max=1023):
+    '''
+    Voltages of ADC samples, NaN for MISSING_SAMPLE
+    '''
+    samples = np.asarray(samples)
+    return np.where(samples == MISSING_SAMPLE, np.nan, samples*(ref_voltage/adc_max))
+
+class MemorySerial:
+    '''
+    In memory stand-in for serial.Serial: write() (e.g. from a thread playing
+    the Arduino) queues bytes that read() returns, waiting up to timeout seconds.
+    '''
+    def __init__(self, timeout=0.1):
+        self.timeout = timeout
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            return len(self.buf)
+
+    def write(self, data):
+        with self.cond:
+            self.buf += data
+            self.cond.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.buf) >= size, self.timeout)
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+            return data
+
+    def close(self):
+        pass
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    num_frames = 2000
+    samples_per_frame = 100
+    ser = MemorySerial()
+    sent = rng.integers(0, 1024, size=(num_frames, samples_per_frame))
+    stream = bytearray()
+    for seq in range(num_frames):
+        frame = bytearray(encode_frame(seq, sent[seq]))
+        # Corrupt one frame in a hundred
+        if(seq % 100 == 50):
+            frame[rng.integers(0, len(frame))] ^= 0xFF
+        stream += frame
+
+    with PhotodiodeReader(ser) as reader:
+        start_time = time.perf_counter()
+        # Arrives in uneven chunks, like over USB
+        pos = 0
+        while(pos < len(stream)):
+            step = int(rng.integers(1, 8192))
+            ser.write(bytes(stream[pos:pos+step]))
+            pos += step
+        num_read = 0
+        while(True):
+            values, _ = reader.read(10000, timeout=0.2)
+            if(len(values) == 0):
+                break
+            num_read += len(values)
+        # Without the final wait for more samples
+        duration_s = time.perf_counter() - start_time - 0.2
+    print(f'{num_read:,} of {sent.size:,} samples in {duration_s*1e3:.1f}ms ({num_read/duration_s:,.0f} samples/s)')
+    print(reader.stats())
+
+    # A frame larger than the ring keeps its newest samples, in order
+    reader = PhotodiodeReader(MemorySerial(), capacity=8)
+    reader.push(np.arange(5), 0.0)
+    reader.push(np.arange(100, 110), 0.0)
+    assert list(reader.latest(8)[0]) == list(range(102, 110)), reader.latest(8)[0]
+    assert list(reader.read(8)[0]) == list(range(102, 110))
+    print('Ring wraparound ok')
+
+    # A corrupt frame reads as a batch of MISSING_SAMPLE, the batches after it stay in place
+    ser = MemorySerial()
+    with PhotodiodeReader(ser) as reader:
+        for seq in range(5):
+            frame = bytearray(encode_frame(seq, np.full(samples_per_frame, seq)))
+            if(seq == 1):
+                frame[-1] ^= 0xFF
+            ser.write(bytes(frame))
+        batches = [reader.read(samples_per_frame, timeout=1.0)[0] for _ in range(5)]
+    assert np.all(batches[1] == MISSING_SAMPLE), batches[1]
+    assert [int(batch[0]) for idx, batch in enumerate(batches) if idx != 1] == [0, 2, 3, 4]
+    print('Lost frame filled ok')
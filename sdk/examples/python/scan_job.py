@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable dual photography scans.
+
+A ScanJob keeps everything about a raster scan in one directory:
+
+    params.json  - the scan parameters (RasterScan arguments, dac rate, exposure)
+    results.npy  - per pixel count, mean, m2 and missing samples (acquisition.ScanAccumulator)
+    progress.npy - one bit per row, set once the row is complete
+
+Both .npy files are memory mapped, so the results are on disk as the scan
+runs. The job scans rows_per_chunk rows at a time with an AcquisitionPipeline,
+adds them to the results and marks them done, flushing the files every
+flush_interval seconds. Writes to a memory map survive the process crashing,
+so after a crash or a USB error opening the same directory again resumes
+from the first row that is not done, rows that were half scanned are
+cleared and scanned again. The kernel writes the pages of the two files
+back in any order though, so after a power loss or an OS crash a row may be
+marked done with its results older than the last flush.
+
+job_path names a job directory after the hash of its parameters, so a
+changed scan starts a new job instead of clashing with an old one.
+
+Run this file for a demo with the simulated dac that fails half way and resumes.
+"""
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import laser_lib
+import acquisition
+
+PARAMS_FILE = 'params.json'
+RESULTS_FILE = 'results.npy'
+PROGRESS_FILE = 'progress.npy'
+
+# RasterScan arguments a job stores, with their defaults
+SCAN_DEFAULTS = {'num_cols': None,
+                 'num_rows': None,
+                 'x_range': (-1.0, 1.0),
+                 'y_range': (-1.0, 1.0),
+                 'dwell': 1,
+                 'overscan': 0.0,
+                 'turnaround': 'cosine',
+                 'turnaround_points': 16,
+                 'serpentine': True,
+                 'color': (1.0, 1.0, 1.0)}
+
+def job_path(directory, params):
+    '''
+    Path of the job for params in directory, e.g. directory/scan_200x200_1a2b3c4d
+    '''
+    params = ScanJob.normalize(params)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:8]
+    return os.path.join(directory, f"scan_{params['num_cols']}x{params['num_rows']}_{digest}")
+
+class ScanJob:
+    '''
+    A raster scan persisted in the directory path. Without an existing job
+    there, params (RasterScan arguments plus dac_rate, exposure and
+    sensor_offset) are required and a new job is made. With one, it is
+    resumed and params, if given, have to match the stored ones.
+    '''
+    def __init__(self, path, params=None, rows_per_chunk=1, flush_interval=10.0, export_interval=None, export_fn=None):
+        self.path = path
+        self.rows_per_chunk = rows_per_chunk
+        self.flush_interval = flush_interval
+        params_path = os.path.join(path, PARAMS_FILE)
+        self.resumed = os.path.exists(params_path)
+        if(self.resumed):
+            with open(params_path) as f:
+                stored = json.load(f)
+            if(params is not None and self.normalize(params) != stored):
+                raise ValueError(f'The job in {path} was started with other parameters: {stored}')
+            self.params = stored
+        else:
+            if(params is None):
+                raise ValueError(f'No scan job in {path}, params are needed to start one')
+            self.params = self.normalize(params)
+            os.makedirs(path, exist_ok=True)
+        shape = (self.params['num_rows'], self.params['num_cols'])
+        self.results = acquisition.ScanAccumulator(shape, path=os.path.join(path, RESULTS_FILE),
+                                                   export_interval=export_interval, export_fn=export_fn,
+                                                   resume=self.resumed)
+        progress_path = os.path.join(path, PROGRESS_FILE)
+        num_bytes = (shape[0] + 7)//8
+        if(self.resumed and os.path.exists(progress_path)):
+            self.progress = np.lib.format.open_memmap(progress_path, mode='r+')
+        else:
+            self.progress = np.lib.format.open_memmap(progress_path, mode='w+', dtype=np.uint8, shape=(num_bytes,))
+        # Params go last, a job without them is started over
+        if(not self.resumed):
+            self.flush()
+            with open(params_path + '.tmp', 'w') as f:
+                json.dump(self.params, f, indent=2)
+            os.replace(params_path + '.tmp', params_path)
+        else:
+            # Rows that were interrupted hold part of a scan
+            self.results.clear_rows(~self.rows_done())
+        self.last_flush = time.perf_counter()
+
+    @staticmethod
+    def normalize(params):
+        '''
+        params with the defaults filled in, as stored in params.json
+        '''
+        unknown = set(params) - set(SCAN_DEFAULTS) - {'dac_rate', 'exposure', 'sensor_offset'}
+        if(unknown):
+            raise ValueError(f'Unknown scan parameters {sorted(unknown)}')
+        normalized = dict(SCAN_DEFAULTS)
+        normalized.update({'dac_rate': None, 'exposure': 0.0, 'sensor_offset': 0.0})
+        normalized.update(params)
+        if(normalized['num_cols'] is None or normalized['num_rows'] is None):
+            raise ValueError('num_cols and num_rows are required')
+        # Through json so tuples and lists compare equal
+        return json.loads(json.dumps(normalized))
+
+    def rows_done(self):
+        return np.unpackbits(self.progress)[:self.params['num_rows']].astype(bool)
+
+    def mark_rows_done(self, rows):
+        for row in rows:
+            self.progress[row >> 3] |= 0x80 >> (row & 7)
+
+    @property
+    def done(self):
+        return bool(np.all(self.rows_done()))
+
+    def reset(self):
+        '''
+        Forgets every scanned row, to scan a finished job again
+        '''
+        self.results.clear_rows(slice(None))
+        self.progress[:] = 0
+        self.flush()
+
+    def flush(self):
+        self.results.flush()
+        self.progress.flush()
+        self.last_flush = time.perf_counter()
+
+    def chunk_scan(self, first_row, num_rows):
+        '''
+        RasterScan of num_rows rows of the job starting at first_row
+        '''
+        scan_args = {name: self.params[name] for name in SCAN_DEFAULTS}
+        ys = np.linspace(scan_args['y_range'][0], scan_args['y_range'][1], scan_args['num_rows'])
+        scan_args['num_rows'] = num_rows
+        scan_args['y_range'] = (ys[first_row], ys[first_row + num_rows - 1])
+        return laser_lib.RasterScan(**scan_args)
+
+    def chunks(self):
+        '''
+        (first_row, num_rows) of the runs of rows left to scan, at most rows_per_chunk long
+        '''
+        todo = np.flatnonzero(~self.rows_done())
+        chunks = []
+        for row in todo:
+            if(chunks and chunks[-1][0] + chunks[-1][1] == row and chunks[-1][1] < self.rows_per_chunk):
+                chunks[-1][1] += 1
+            else:
+                chunks.append([row, 1])
+        return [(int(first_row), num_rows) for first_row, num_rows in chunks]
+
+    def duration(self, dac_rate=None):
+        '''
+        Seconds the rows that are not done yet take at the job's dac_rate 
+        (or dac_rate if it has none), without the moves between chunks.
+        Worked out from the parameters, the scans are not built.
+        '''
+        if(self.params['dac_rate'] is not None):
+            dac_rate = self.params['dac_rate']
+        num_points = sum(laser_lib.RasterScan.num_points(self.params['num_cols'], num_rows, self.params['dwell'],
+                                                         self.params['overscan'], self.params['turnaround_points'])
+                         for _, num_rows in self.chunks())
+        return num_points/dac_rate
+
+    def run(self, queue, sensor):
+        '''
+        Scans the rows that are not done yet, returns (image, counts) like
+        AcquisitionPipeline.run. Whatever fails is raised after the finished
+        rows are flushed, so running the job again continues from there.
+        '''
+        if(self.params['dac_rate'] is not None):
+            queue.dac_rate = self.params['dac_rate']
+        num_cols = self.params['num_cols']
+        try:
+            for first_row, num_rows in self.chunks():
+                scan = self.chunk_scan(first_row, num_rows)
+                chunk_results = acquisition.ScanAccumulator((num_rows, num_cols))
+                pipeline = acquisition.AcquisitionPipeline(queue, scan, sensor, exposure=self.params['exposure'],
+                                                           sensor_offset=self.params['sensor_offset'],
+                                                           accumulator=chunk_results)
+                pipeline.run()
+                self.results.merge(chunk_results, pixel_offset=first_row*num_cols)
+                self.mark_rows_done(range(first_row, first_row + num_rows))
+                if(time.perf_counter() - self.last_flush >= self.flush_interval):
+                    self.flush()
+        finally:
+            self.flush()
+        return self.results.mean(), self.results.count()
+
+    def stats(self):
+        rows_done = self.rows_done()
+        return {'rows_done': int(np.sum(rows_done)),
+                'rows': len(rows_done),
+                'resumed': self.resumed,
+                'samples': self.results.samples}
+
+if __name__ == "__main__":
+    import tempfile
+    import helios_sim
+
+    class FailingSensor:
+        '''
+        Passes reads through to sensor until fail_after of them, then raises
+        '''
+        def __init__(self, sensor, fail_after):
+            self.sensor = sensor
+            self.fail_after = fail_after
+
+        def read(self):
+            self.fail_after -= 1
+            if(self.fail_after < 0):
+                raise IOError('Sensor unplugged')
+            return self.sensor.read()
+
+    num_cols, num_rows = 40, 30
+    yy, xx = np.mgrid[0:num_rows, 0:num_cols]
+    scene = 0.2 + 0.3*xx/num_cols + 0.5*((xx - num_cols/2)**2 + (yy - num_rows/2)**2 < (num_rows/4)**2)
+
+    lib = helios_sim.SimulatedHeliosLib()
+    queue = laser_lib.DacQueue(dac=laser_lib.Dac(lib=lib))
+    queue.color_shifts = [0, 0, 0]
+    sample_rate = 2000
+    params = {'num_cols': num_cols, 'num_rows': num_rows, 'dwell': 4*30000//sample_rate, 'overscan': 0.05,
+              'dac_rate': 30000, 'exposure': 1.0/sample_rate}
+    sensor = acquisition.SyntheticSensor(lib, scene, sample_rate=sample_rate, xy_max=queue.dac.xy_max,
+                                         max_scale=queue.max_scale)
+
+    with tempfile.TemporaryDirectory() as directory:
+        job_path = os.path.join(directory, 'job')
+        job = ScanJob(job_path, params, rows_per_chunk=4)
+        try:
+            # Fails in the middle of the scan
+            job.run(queue, FailingSensor(sensor, fail_after=sample_rate))
+        except IOError as e:
+            print(f'Scan failed ({e}) after {job.stats()}')
+        job = ScanJob(job_path, params, rows_per_chunk=4)
+        print(f'Resuming at row {job.chunks()[0][0]}')
+        image, counts = job.run(queue, sensor)
+        valid = counts > 0
+        corr = np.corrcoef(image[valid], scene[valid])[0, 1]
+        print(f'{job.stats()}, {np.mean(valid)*100:.0f}% of pixels sampled, correlation with scene {corr:.3f}')